@@ -1,26 +1,130 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import json
 from asyncio import Future
 import asyncio
-from typing import Any, BinaryIO, Dict
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import os
+from typing import Any, BinaryIO, Callable, Dict, Optional
 import logging
 
-from fastapi import FastAPI, Request, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Response, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+import prometheus_client
 
+from ibm_cloud_sdk_core.http_adapter import SSLHTTPAdapter
 from ibm_watson import DiscoveryV2
-from ibm_watson.discovery_v2 import QueryLargePassages
+from ibm_watson.discovery_v2 import QueryLargePassages, QueryLargeSuggestedRefinements, QueryLargeTableResults
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
 
-# in-memory store for mapping (project_id, collection_id, document_id) to Future object
-docproc_requests: dict[(str, str, str), Future] = {}
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sweep expired document processing requests and idle status pollers in the background
+    sweeper = asyncio.create_task(sweep_docproc_requests())
+    yield
+    sweeper.cancel()
+    for poller in status_pollers.values():
+        poller.task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Seconds an extraction request waits for the document processing before responding with 504
+DOCUMENT_TIMEOUT = float(os.getenv('DOCUMENT_TIMEOUT', '600'))
+# Seconds between checks whether the client of an extraction request has disconnected
+DISCONNECT_CHECK_INTERVAL = float(os.getenv('DISCONNECT_CHECK_INTERVAL', '1'))
+# Seconds between sweeps of expired document processing requests and idle status pollers
+SWEEP_INTERVAL = float(os.getenv('SWEEP_INTERVAL', '60'))
+
+
+@dataclass
+class DocprocRequest:
+    # A suspended document processing request, resumed by setting the processing status as the result of the future
+    future: Future
+    deadline: float
+
+
+# in-memory store for mapping (project_id, collection_id, document_id) to DocprocRequest object
+docproc_requests: dict[(str, str, str), DocprocRequest] = {}
 
 discovery = DiscoveryV2(version='2023-03-31')
 
+# The Discovery SDK is blocking, so its calls run in a bounded thread pool instead of on the event loop
+DISCOVERY_CONCURRENCY = int(os.getenv('DISCOVERY_CONCURRENCY', '16'))
+discovery_executor = ThreadPoolExecutor(max_workers=DISCOVERY_CONCURRENCY, thread_name_prefix='discovery')
+# Keep a connection per thread alive, instead of the default pool of 10 connections.
+# The adapter of the SDK is replaced, so its TLS settings and retries are carried over. retry_config is None
+# unless retries are enabled on the client, and requests would then retry 3 times instead of the SDK's none.
+discovery_adapter = SSLHTTPAdapter(
+    pool_maxsize=DISCOVERY_CONCURRENCY,
+    max_retries=discovery.retry_config or 0,
+    _disable_ssl_verification=discovery.disable_ssl_verification
+)
+discovery.http_client.mount('http://', discovery_adapter)
+discovery.http_client.mount('https://', discovery_adapter)
+
+
+async def call_discovery(method: Callable, *args, **kwargs):
+    # Run a Discovery SDK method in the thread pool and return the result of its response
+    loop = asyncio.get_running_loop()
+    response = await loop.run_in_executor(discovery_executor, functools.partial(method, *args, **kwargs))
+    return response.get_result()
+
+
+# Comma-separated fields of the processed document to return, e.g. `document_id,extracted_metadata,enriched_text`. All fields when empty.
+DOCUMENT_FIELDS = [name.strip() for name in os.getenv('DOCUMENT_FIELDS', '').split(',') if name.strip()]
+# Processed documents whose decoded query response exceeds this many bytes are streamed back as they are encoded
+STREAM_THRESHOLD = int(os.getenv('STREAM_THRESHOLD', str(1024 * 1024)))
+# Bytes of each chunk of a streamed document
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+# The document status of collections without document status webhook is pulled at an interval that starts at POLL_INTERVAL_MIN
+# and grows exponentially up to POLL_INTERVAL_MAX seconds while no document completes
+POLL_INTERVAL_MIN = float(os.getenv('POLL_INTERVAL_MIN', '1'))
+POLL_INTERVAL_MAX = float(os.getenv('POLL_INTERVAL_MAX', '16'))
+# The maximum number of pending documents listed by a single status request
+POLL_PAGE_SIZE = int(os.getenv('POLL_PAGE_SIZE', '1000'))
+
+
+@dataclass
+class StatusPoller:
+    # Pulls the processing status of all the pending documents of a collection with one request per interval
+    project_id: str
+    collection_id: str
+    document_ids: set[str] = field(default_factory=set)
+    # Set when a document is added, so that the poller shortens its interval
+    added: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
+
+
+# Seconds the document status webhook configuration of a collection is cached
+COLLECTION_CACHE_TTL = float(os.getenv('COLLECTION_CACHE_TTL', '300'))
+
+# in-memory cache mapping (project_id, collection_id) to the expiry time and the task retrieving whether document status webhook is enabled
+webhook_status_cache: dict[(str, str), (float, asyncio.Task)] = {}
+
+# in-memory store for mapping (project_id, collection_id) to the StatusPoller of the collection
+status_pollers: dict[(str, str), StatusPoller] = {}
+
+# Metrics exposed at GET /metrics
+WAIT_BUCKETS = (1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+prometheus_client.Gauge('docproc_requests_outstanding', 'Extraction requests waiting for the document processing').set_function(lambda: len(docproc_requests))
+prometheus_client.Gauge('docproc_status_pollers', 'Collections whose document status is pulled').set_function(lambda: len(status_pollers))
+prometheus_client.Gauge('docproc_polled_documents', 'Documents whose status is pulled').set_function(lambda: sum(len(poller.document_ids) for poller in status_pollers.values()))
+docproc_results = prometheus_client.Counter('docproc_requests_total', 'Extraction requests by result: available, failed, timeout or disconnected', ['result'])
+docproc_wait_seconds = prometheus_client.Histogram('docproc_wait_seconds', 'Seconds an extraction request waited for the document processing', buckets=WAIT_BUCKETS)
+
+
+# Metrics endpoint in the Prometheus text format. It runs on the event loop, so that the gauges read consistent state.
+@app.get("/metrics")
+async def metrics():
+    return Response(content=prometheus_client.generate_latest(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
 
 @app.post("/webhook")
 async def webhook(
@@ -37,6 +141,8 @@ async def webhook(
         event = body["event"]
         response_body: dict[str, Any] = {}
         if event == "ping":
+            # A ping is sent when the webhook is configured, so the collection configuration may have changed
+            invalidate_webhook_status(body.get("data"))
             response_body["accepted"] = True
         elif event == "document.status":
             data = body["data"]
@@ -55,43 +161,127 @@ async def webhook(
 
 @app.post("/projects/{project_id}/collections/{collection_id}/extract")
 async def post_and_extraction(
+    project_id: str,
+    collection_id: str,
+    file: UploadFile,
+    request: Request
+):
+    # Process the document in a task that is cancelled when the client disconnects, so that an abandoned request stops waiting
+    extraction = asyncio.create_task(extract_document(project_id, collection_id, file))
+    watcher = asyncio.create_task(cancel_on_disconnect(request, extraction))
+    try:
+        return await extraction
+    except asyncio.CancelledError:
+        if not (watcher.done() and watcher.result()):
+            raise
+        logger.info(f'client of the extraction from {project_id}/{collection_id} disconnected')
+        docproc_results.labels('disconnected').inc()
+        # The client is gone, so the response is never read
+        return Response(status_code=499)
+    finally:
+        watcher.cancel()
+
+
+async def cancel_on_disconnect(
+    request: Request,
+    task: asyncio.Task
+):
+    # Cancel the task when the client disconnects. Return whether it did.
+    while not task.done():
+        if await request.is_disconnected():
+            task.cancel()
+            return True
+        await asyncio.sleep(DISCONNECT_CHECK_INTERVAL)
+    return False
+
+
+async def extract_document(
     project_id: str,
     collection_id: str,
     file: UploadFile
 ):
     # Ingest the received document into the underlying Discovery project/collection
     logger.info(f'using project/collection {project_id}/{collection_id}')
-    document_id = add_document(project_id, collection_id, file.file, file.filename)
+    document_id = await add_document(project_id, collection_id, file.file, file.filename)
 
     # Wait until the ingested document become available
     logger.info(f'waiting for {document_id} become available')
-    available = await wait_document_completion(project_id, collection_id, document_id)
+    try:
+        available = await wait_document_completion(project_id, collection_id, document_id)
+    except asyncio.TimeoutError:
+        logger.info(f'{document_id} is not processed in {DOCUMENT_TIMEOUT} seconds')
+        docproc_results.labels('timeout').inc()
+        return JSONResponse(content={'document_id': document_id, 'error': 'The document processing timed out'}, status_code=504)
+    docproc_results.labels('available' if available else 'failed').inc()
 
     # Retrieve the processed document
     logger.info(f'{document_id} is available:{available}')
-    document = get_document(project_id, collection_id, document_id)
+    document, size = await get_document(project_id, collection_id, document_id)
+    if size > STREAM_THRESHOLD:
+        # Encode a large document incrementally in a worker thread while it is sent, instead of all at once on the event loop
+        return StreamingResponse(encode_document(document), media_type='application/json')
     return JSONResponse(content=document)
 
 
-def add_document(
+def encode_document(
+    document: Dict[str, Any]
+):
+    # Yield the JSON encoding of the document in chunks of about STREAM_CHUNK_SIZE bytes
+    encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+    chunk = []
+    size = 0
+    for part in encoder.iterencode(document):
+        chunk.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+async def add_document(
     project_id: str, 
     collection_id: str, 
     file: BinaryIO, 
     filename: Any
 ):
-    response = discovery.add_document(project_id, collection_id, file=file, filename=filename)
-    document_id = response.get_result()['document_id']
+    result = await call_discovery(discovery.add_document, project_id, collection_id, file=file, filename=filename)
+    document_id = result['document_id']
     return document_id
 
 
-def get_document(
+async def get_document(
     project_id: str, 
     collection_id: str, 
     document_id: str,
 ):
-    response = discovery.query(project_id=project_id, collection_ids=[collection_id], filter=f'document_id::{document_id}', passages=QueryLargePassages(enabled=False))
-    document = response.get_result()['results'][0]
-    return document
+    # Return the processed document and the decoded size of the query response in bytes.
+    # The document API returns only the processing status, so the document is retrieved by a filter-only query
+    # that skips passages, table results, suggestions and highlighting, and returns only DOCUMENT_FIELDS if set.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(discovery_executor, functools.partial(
+        query_document,
+        project_id=project_id,
+        collection_ids=[collection_id],
+        filter=f'document_id::{document_id}',
+        count=1,
+        return_=DOCUMENT_FIELDS or None,
+        highlight=False,
+        spelling_suggestions=False,
+        passages=QueryLargePassages(enabled=False),
+        table_results=QueryLargeTableResults(enabled=False),
+        suggested_refinements=QueryLargeSuggestedRefinements(enabled=False)
+    ))
+
+
+def query_document(**kwargs):
+    # Query a document and return it with the size of the response body. The response is streamed, so that the body
+    # is measured after the gzip content encoding is decoded, whether or not a Content-Length was sent.
+    with discovery.query(**kwargs, stream=True).get_result() as response:
+        content = response.content
+    return json.loads(content)['results'][0], len(content)
 
 
 async def wait_document_completion(
@@ -100,57 +290,172 @@ async def wait_document_completion(
     document_id: str,
 ):
     global docproc_requests
-    docproc_request = Future()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    docproc_request = DocprocRequest(loop.create_future(), started + DOCUMENT_TIMEOUT)
     key = (project_id, collection_id, document_id)
     docproc_requests[key] = docproc_request
+    try:
+        # Let the status poller of the collection pull the processing status when the collection is not configured with document status webhook
+        if not await is_webhook_status_enabled(project_id, collection_id):
+            poll_document_status(project_id, collection_id, document_id)
 
-    # Start a background task to pull the processing status periodically when the collection is not configured with document status webhook
-    if not is_webhook_status_enabled(project_id, collection_id):
-        asyncio.create_task(wait_document_available(project_id, collection_id, document_id))
+        # Wait until the document become available or failed, or the deadline passes
+        status = await asyncio.wait_for(docproc_request.future, max(docproc_request.deadline - loop.time(), 0))
+        return status == "available"
+    finally:
+        # Forget the request also when it timed out or was cancelled, so that it does not leak
+        if docproc_requests.get(key) is docproc_request:
+            docproc_requests.pop(key)
+        docproc_wait_seconds.observe(loop.time() - started)
 
-    # Wait until the document become available or failed
-    status = await docproc_request
-    return status == "available"
+
+async def is_webhook_status_enabled(
+    project_id: str,
+    collection_id: str
+):
+    # The collection configuration rarely changes, so it is cached for COLLECTION_CACHE_TTL seconds.
+    # Concurrent requests for the same collection share a single retrieval.
+    key = (project_id, collection_id)
+    now = asyncio.get_running_loop().time()
+    cached = webhook_status_cache.get(key)
+    if cached is None or cached[0] <= now:
+        cached = (now + COLLECTION_CACHE_TTL, asyncio.create_task(get_webhook_status(project_id, collection_id)))
+        webhook_status_cache[key] = cached
+    try:
+        # Shielded, so that a cancelled request does not cancel the retrieval of the other requests
+        return await asyncio.shield(cached[1])
+    except Exception:
+        # Do not cache failures
+        if webhook_status_cache.get(key) is cached:
+            webhook_status_cache.pop(key)
+        raise
 
 
-def is_webhook_status_enabled(
+async def get_webhook_status(
     project_id: str,
     collection_id: str
 ):
-    webhook = discovery.get_collection(project_id, collection_id).get_result().get('webhooks')
+    webhook = (await call_discovery(discovery.get_collection, project_id, collection_id)).get('webhooks')
     return (webhook is not None) and ('document_status' in webhook)
 
 
-async def wait_document_available(
+def invalidate_webhook_status(
+    data: Optional[Dict[str, Any]]
+):
+    # Forget the cached configuration of the collection of a ping event, or of all collections if the event does not name one
+    if data and 'project_id' in data and 'collection_id' in data:
+        webhook_status_cache.pop((data['project_id'], data['collection_id']), None)
+    else:
+        webhook_status_cache.clear()
+
+
+def poll_document_status(
+    project_id: str,
+    collection_id: str,
+    document_id: str
+):
+    # Add the document to the status poller of the collection, starting the poller if there is none
+    key = (project_id, collection_id)
+    poller = status_pollers.get(key)
+    if poller is None:
+        poller = StatusPoller(project_id, collection_id)
+        status_pollers[key] = poller
+        poller.task = asyncio.create_task(run_status_poller(poller))
+    poller.document_ids.add(document_id)
+    poller.added.set()
+
+
+async def run_status_poller(
+    poller: StatusPoller
+):
+    # Pull the processing status of the pending documents of the collection until none is left.
+    # The interval doubles up to POLL_INTERVAL_MAX while no document completes, and is reset when one completes or is added.
+    interval = POLL_INTERVAL_MIN
+    while True:
+        interval = await sleep_until_next_poll(poller, interval)
+        try:
+            completed = await poll_collection_status(poller)
+        except Exception as e:
+            logger.error(f'failed to pull the document status of {poller.project_id}/{poller.collection_id}: {e}')
+            completed = 0
+        if not poller.document_ids:
+            if status_pollers.get((poller.project_id, poller.collection_id)) is poller:
+                status_pollers.pop((poller.project_id, poller.collection_id))
+            return
+        interval = POLL_INTERVAL_MIN if completed else min(interval * 2, POLL_INTERVAL_MAX)
+
+
+async def sleep_until_next_poll(
+    poller: StatusPoller,
+    interval: float
+):
+    # Sleep for the interval, but no longer than POLL_INTERVAL_MIN after a document is added. Return the interval of the poll.
+    poller.added.clear()
+    try:
+        await asyncio.wait_for(poller.added.wait(), interval)
+    except asyncio.TimeoutError:
+        return interval
+    await asyncio.sleep(min(interval, POLL_INTERVAL_MIN))
+    return POLL_INTERVAL_MIN
+
+
+async def poll_collection_status(
+    poller: StatusPoller
+):
+    # Forget the documents whose requests were resumed in the meantime, e.g. by a webhook event
+    poller.document_ids = {document_id for document_id in poller.document_ids if (poller.project_id, poller.collection_id, document_id) in docproc_requests}
+    if not poller.document_ids:
+        return 0
+
+    # List the pending documents of the collection with a single request.
+    # The listed documents are still being processed, and only the others need to be checked one by one.
+    result = await call_discovery(
+        discovery.list_documents,
+        poller.project_id,
+        poller.collection_id,
+        count=POLL_PAGE_SIZE,
+        status='pending,processing'
+    )
+    processing = {document['document_id'] for document in result.get('documents', [])}
+    candidates = list(poller.document_ids - processing)
+    statuses = await asyncio.gather(*[get_document_status(poller.project_id, poller.collection_id, document_id) for document_id in candidates])
+
+    # Then, notify the completed documents
+    completed = 0
+    for document_id, status in zip(candidates, statuses):
+        if status is not None:
+            poller.document_ids.discard(document_id)
+            notify_document_completion_status(poller.project_id, poller.collection_id, document_id, status)
+            completed += 1
+    return completed
+
+
+async def get_document_status(
     project_id: str,
     collection_id: str,
     document_id: str
 ):
-    # Pull the document processing status periodically (1 sec interval) and wait until the completion
-    while(discovery.list_documents(
+    # Return the final processing status of the document, 'available' or 'failed',
+    # or None while the document or its child documents are still being processed
+    if (await call_discovery(
+        discovery.list_documents,
         project_id,
         collection_id,
         parent_document_id=document_id,
         count=0,
         status='pending,processing'
-    ).get_result()['matching_results'] != 0
-    ):
-        await asyncio.sleep(1)
-    
-    # Retrieve the document processing status
-    status = discovery.get_document(
-        project_id,
-        collection_id,
-        document_id
-    ).get_result()['status']
+    ))['matching_results'] != 0:
+        return None
 
-    # Then, notify it
-    notify_document_completion_status(
+    # Retrieve the document processing status. A document missing from the page of pending documents may still be pending.
+    status = (await call_discovery(
+        discovery.get_document,
         project_id,
         collection_id,
-        document_id,
-        status
-    )
+        document_id
+    ))['status']
+    return status if status in ('available', 'failed') else None
 
 
 def notify_document_completion_status(
@@ -161,10 +466,31 @@ def notify_document_completion_status(
 ):
     global docproc_requests
     key = (project_id, collection_id, document_id)
-    docproc_request = docproc_requests.get(key)
-    if docproc_request:
-        docproc_request.set_result(status)
-        docproc_requests.pop(key)
+    docproc_request = docproc_requests.pop(key, None)
+    if docproc_request and not docproc_request.future.done():
+        docproc_request.future.set_result(status)
+
+
+async def sweep_docproc_requests():
+    # Periodically expire the requests past their deadline, stop the pollers left without pending documents and drop
+    # expired cache entries, so that nothing leaks when a status event is lost or a request is abandoned
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        now = loop.time()
+        for key, docproc_request in list(docproc_requests.items()):
+            if docproc_request.future.done() or docproc_request.deadline <= now:
+                docproc_requests.pop(key)
+                if not docproc_request.future.done():
+                    docproc_request.future.set_exception(asyncio.TimeoutError())
+        for key, poller in list(status_pollers.items()):
+            poller.document_ids = {document_id for document_id in poller.document_ids if key + (document_id,) in docproc_requests}
+            if not poller.document_ids:
+                status_pollers.pop(key)
+                poller.task.cancel()
+        for key, (expiry, _) in list(webhook_status_cache.items()):
+            if expiry <= now:
+                webhook_status_cache.pop(key)
 
 
 
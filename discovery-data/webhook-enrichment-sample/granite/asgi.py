@@ -0,0 +1,117 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import fastapi
+import httpx
+
+import main
+from async_batch_worker import AsyncDiscoveryBatchClient, collect, dispatch_batches
+
+# Async server of the webhook enrichment. Run it with `uvicorn asgi:app --host 0.0.0.0 --port 8080`.
+# It serves the same endpoints as main.py, and one event loop multiplexes the batch downloads and uploads
+# and the generation requests, while the documents are enriched in threads.
+
+logger = main.app.logger
+
+class AsyncGenerationClient(main.GenerationClient):
+    """Generation client that sends the requests with an async HTTP client on the event loop.
+
+    The packing and caching of extract_entities_batch() still run in threads, but the requests they make
+    through generate() are multiplexed on the event loop instead of blocking a connection per thread.
+    """
+
+    def __init__(self, concurrency, timeout, max_retries):
+        super().__init__(concurrency, timeout, max_retries)
+        self.loop = None
+        self.client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency))
+        self.token_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='token')
+
+    def generate(self, prompt, max_new_tokens):
+        return asyncio.run_coroutine_threadsafe(self.agenerate(prompt, max_new_tokens), self.loop).result()
+
+    async def agenerate(self, prompt, max_new_tokens):
+        url, payload, params = self.request(prompt, max_new_tokens)
+        for attempt in range(self.max_retries + 1):
+            # get_token() blocks while the token is fetched, so it runs off the event loop. Its own thread does not
+            # wait behind the default executor, whose threads may all be enriching documents that wait for this request.
+            token = await asyncio.get_running_loop().run_in_executor(self.token_executor, main.token_manager.get_token)
+            headers = {'Authorization': f'Bearer {token}'}
+            try:
+                with main.llm_request_seconds.time():
+                    response = await self.client.post(url, json=payload, params=params, headers=headers)
+            except httpx.TransportError as e:
+                await asyncio.sleep(self.failed(e, attempt))
+                continue
+            result, delay = self.responded(response, token, attempt)
+            if result is not None:
+                return result
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.client.aclose()
+        self.token_executor.shutdown(wait=False)
+
+generation_client = AsyncGenerationClient(main.LLM_CONCURRENCY, main.LLM_TIMEOUT, main.LLM_MAX_RETRIES)
+
+discovery_client = AsyncDiscoveryBatchClient(main.WD_API_URL, main.WD_API_KEY, main.ENRICHMENT_WORKERS * 2, (main.WD_CONNECT_TIMEOUT, main.WD_READ_TIMEOUT), main.WD_MAX_RETRIES)
+
+async def enrich_stream(lines, stats):
+    """Yield the enriched lines of a batch, enriching chunks of documents in threads with a bounded number in flight."""
+    loop = asyncio.get_running_loop()
+    pending = collections.deque()
+    chunk = []
+    async for line in lines:
+        if line:
+            chunk.append(line)
+        if len(chunk) == main.LLM_BATCH_DOCUMENTS:
+            pending.append(loop.run_in_executor(None, main.enrich_lines, chunk))
+            chunk = []
+            if len(pending) > main.ENRICHMENT_WORKERS:
+                for enriched_line in await collect(pending.popleft(), stats):
+                    yield enriched_line
+    if chunk:
+        pending.append(loop.run_in_executor(None, main.enrich_lines, chunk))
+    while pending:
+        for enriched_line in await collect(pending.popleft(), stats):
+            yield enriched_line
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Route the generation requests of extract_entities() to the event loop
+    generation_client.loop = asyncio.get_running_loop()
+    main.generation_client = generation_client
+    main.open_task_queue()
+    main.open_result_cache()
+    main.q.recover()
+    dispatcher = asyncio.create_task(dispatch_batches(main.q, discovery_client, enrich_stream, main.ENRICHMENT_WORKERS, main.STREAMING, logger))
+    logger.info('Started %d enrichment workers (async server)', main.ENRICHMENT_WORKERS)
+    yield
+    dispatcher.cancel()
+    await asyncio.gather(dispatcher, return_exceptions=True)
+    await discovery_client.aclose()
+    await generation_client.aclose()
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+# The endpoints serve the responses of the handlers of main.py
+
+# Metrics endpoint in the Prometheus text format
+@app.get('/metrics')
+def metrics():
+    return fastapi.Response(*main.metrics())
+
+# Cache statistics endpoint
+@app.get('/cache/stats')
+def cache_stats():
+    return main.cache_stats()
+
+# Health endpoint. Reports 503 while the queue is over the high-water mark, so that load balancers shed load.
+@app.get('/health')
+def health():
+    return fastapi.responses.JSONResponse(*main.health())
+
+# Webhook endpoint
+@app.post('/webhook')
+async def webhook(request: fastapi.Request):
+    return fastapi.responses.JSONResponse(*main.handle_webhook(request.headers.get('Authorization'), await request.body()))
@@ -0,0 +1,65 @@
+import collections
+import contextlib
+import prometheus_client
+import time
+
+# Metrics exposed at GET /metrics
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+batches_pulled = prometheus_client.Counter('enrichment_batches_pulled_total', 'Batch downloads by status code', ['status'])
+batches_pushed = prometheus_client.Counter('enrichment_batches_pushed_total', 'Batch uploads by status code', ['status'])
+batch_retries = prometheus_client.Counter('enrichment_batch_retries_total', 'Failed batches scheduled for a retry')
+batches_dead = prometheus_client.Counter('enrichment_batches_dead_total', 'Batches given up after the last attempt')
+batch_errors = prometheus_client.Counter('enrichment_batch_errors_total', 'Failed batch attempts by error class', ['error'])
+phase_seconds = prometheus_client.Histogram('enrichment_phase_seconds', 'Seconds a batch spends in each phase', ['phase'], buckets=PHASE_BUCKETS)
+batch_documents = prometheus_client.Histogram('enrichment_batch_documents', 'Documents per batch', buckets=COUNT_BUCKETS)
+batch_features = prometheus_client.Histogram('enrichment_batch_features', 'Features per batch', buckets=COUNT_BUCKETS)
+webhook_auth = prometheus_client.Counter('enrichment_webhook_auth_total', 'Webhook authorizations by result: cached, verified or rejected', ['result'])
+
+def register_queue_gauges(q):
+    """Report the state of the TaskQueue q in gauges."""
+    prometheus_client.Gauge('enrichment_queue_depth', 'Pending batches in the task queue').set_function(q.qsize)
+    prometheus_client.Gauge('enrichment_batches_in_flight', 'Batches being enriched').set_function(lambda: q.in_flight)
+    prometheus_client.Gauge('enrichment_queue_lag_seconds', 'Seconds the oldest pending batch has waited since it was queued').set_function(lambda: q.stats()['lag'])
+
+class BatchStats:
+    """Seconds a batch spends in each phase, and its numbers of documents and features.
+
+    The phases of a streamed batch are interleaved, so each phase is timed exclusive of the phases nested in it.
+    """
+
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.documents = 0
+        self.features = 0
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.phases.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases.pop()
+            self.seconds[name] += elapsed
+            if self.phases:
+                self.seconds[self.phases[-1]] -= elapsed
+
+    def timed(self, name, iterable):
+        """Yield the items of iterable, timing their production as the phase."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def observe(self):
+        for name, seconds in self.seconds.items():
+            phase_seconds.labels(name).observe(seconds)
+        batch_documents.observe(self.documents)
+        batch_features.observe(self.features)
@@ -0,0 +1,72 @@
+import collections
+
+class EntityMatcher:
+    """Aho-Corasick automaton that locates many entity strings in a single pass over a text.
+
+    It has no dependency on the webhook application, so other samples can reuse it as is.
+    """
+
+    def __init__(self, entities):
+        """entities is an iterable of (text, value) pairs. Duplicate texts keep the first value."""
+        self.entities = []
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [[]]
+        seen = set()
+        for text, value in entities:
+            if not text or text in seen:
+                continue
+            seen.add(text)
+            self.add(text, len(self.entities))
+            self.entities.append((text, value))
+        self.link()
+
+    def add(self, text, index):
+        state = 0
+        for char in text:
+            next_state = self.transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append([])
+                self.transitions[state][char] = next_state
+            state = next_state
+        self.outputs[state].append(index)
+
+    def link(self):
+        # Breadth-first, so that the failure state of every shallower state is already known
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.failures[next_state]]
+
+    def find_all(self, text):
+        """Yield (begin, end, index) of every occurrence, including overlapping ones."""
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            for index in outputs[state]:
+                yield position + 1 - len(self.entities[index][0]), position + 1, index
+
+    def find(self, text):
+        """Return (begin, end, value) of non-overlapping occurrences, preferring the leftmost and then the longest one."""
+        matches = sorted(self.find_all(text), key=lambda match: (match[0], -match[1]))
+        found = []
+        last_end = 0
+        for begin, end, index in matches:
+            if begin >= last_end:
+                found.append((begin, end, self.entities[index][1]))
+                last_end = end
+        return found
@@ -0,0 +1,82 @@
+import array
+import json
+
+class FeatureBuffer:
+    """Features of a document in columns, serialized straight to its line of the batch file.
+
+    Locations are kept in arrays and properties by reference, so that the features sharing a
+    properties dict, such as the sentence classes of a rule, are stored and encoded once.
+    entity_text is kept apart from the properties, so that entities of a type can share them as well.
+    """
+
+    __slots__ = ('document_id', 'begins', 'ends', 'properties', 'texts')
+
+    # Values of begins that mark the features without a location
+    DOCUMENT = -1
+    NOTICE = -2
+
+    def __init__(self, document_id):
+        self.document_id = document_id
+        self.begins = array.array('q')
+        self.ends = array.array('q')
+        self.properties = []
+        self.texts = []
+
+    def __len__(self):
+        return len(self.properties)
+
+    def annotation(self, begin, end, properties, entity_text=None):
+        """Add an annotation feature. begin and end are None for document-level annotations."""
+        self.begins.append(self.DOCUMENT if begin is None else begin)
+        self.ends.append(self.DOCUMENT if end is None else end)
+        self.properties.append(properties)
+        self.texts.append(entity_text)
+
+    def notice(self, description, created):
+        """Add a notice feature."""
+        self.begins.append(self.NOTICE)
+        self.ends.append(self.NOTICE)
+        self.properties.append({'description': description, 'created': created})
+        self.texts.append(None)
+
+    def encode(self, dumps):
+        """Return the enriched document as a line of the batch file. dumps is the bytes encoder of load_codec()."""
+        # Properties dict id -> its encoding, valid while self.properties holds the dicts
+        encoded = {}
+        features = []
+        for begin, end, properties, entity_text in zip(self.begins, self.ends, self.properties, self.texts):
+            encoded_properties = encoded.get(id(properties))
+            if encoded_properties is None:
+                encoded_properties = encoded[id(properties)] = dumps(properties)
+            if entity_text is not None:
+                # Splice entity_text into the encoded object, with no comma if it is empty
+                separator = b'' if encoded_properties == b'{}' else b','
+                encoded_properties = b'%s%s"entity_text":%s}' % (encoded_properties[:-1], separator, dumps(entity_text))
+            if begin >= 0:
+                features.append(b'{"type":"annotation","location":{"begin":%d,"end":%d},"properties":%s}' % (begin, end, encoded_properties))
+            elif begin == self.DOCUMENT:
+                features.append(b'{"type":"annotation","properties":%s}' % encoded_properties)
+            else:
+                features.append(b'{"type":"notice","properties":%s}' % encoded_properties)
+        return b'{"document_id":%s,"features":[%s]}' % (dumps(self.document_id), b','.join(features))
+
+    def __repr__(self):
+        return self.encode(load_codec('json')[1]).decode('utf-8')
+
+def load_codec(name):
+    """Return the (loads, dumps) pair of the JSON codec. dumps returns bytes."""
+    if name in ('auto', 'orjson'):
+        try:
+            import orjson
+            return orjson.loads, orjson.dumps
+        except ImportError:
+            if name == 'orjson':
+                raise
+    if name in ('auto', 'msgspec'):
+        try:
+            import msgspec
+            return msgspec.json.decode, msgspec.json.encode
+        except ImportError:
+            if name == 'msgspec':
+                raise
+    return json.loads, lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8')
@@ -1,47 +1,192 @@
+import concurrent.futures
 import flask
-import gzip
+import hashlib
+import itertools
 import json
 import jwt
 import logging
 import os
-import queue
+import prometheus_client
+import random
 import re
 import requests
+import sqlite3
 import threading
 import time
 
+import batch_worker
+from batch_client import DiscoveryBatchClient
+from batch_stats import PHASE_BUCKETS, BatchStats, register_queue_gauges, webhook_auth
+from entity_matcher import EntityMatcher
+from features import FeatureBuffer, load_codec
+from task_queue import TaskQueue
+from webhook_verifier import WebhookVerifier
+
 WD_API_URL = os.getenv('WD_API_URL')
 WD_API_KEY = os.getenv('WD_API_KEY')
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Connect and read timeouts of Discovery batch API requests in seconds
+WD_CONNECT_TIMEOUT = float(os.getenv('WD_CONNECT_TIMEOUT', '10'))
+WD_READ_TIMEOUT = float(os.getenv('WD_READ_TIMEOUT', '300'))
+# Maximum number of retries of a Discovery batch download
+WD_MAX_RETRIES = int(os.getenv('WD_MAX_RETRIES', '3'))
 IBM_CLOUD_API_KEY = os.getenv('IBM_CLOUD_API_KEY')
 WML_ENDPOINT_URL = os.getenv('WML_ENDPOINT_URL', 'https://us-south.ml.cloud.ibm.com')
 WML_INSTANCE_CRN = os.getenv('WML_INSTANCE_CRN')
+IAM_ENDPOINT_URL = os.getenv('IAM_ENDPOINT_URL', 'https://iam.cloud.ibm.com')
+# Refresh the IAM token this many seconds before it expires
+IAM_REFRESH_MARGIN = float(os.getenv('IAM_REFRESH_MARGIN', '300'))
+# Number of batches enriched concurrently
+ENRICHMENT_WORKERS = int(os.getenv('ENRICHMENT_WORKERS', '1'))
+# Stream documents from the download through enrichment to the upload instead of buffering the whole batch
+STREAMING = os.getenv('STREAMING', 'false').lower() == 'true'
+# Level of the application log
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Log the full payloads of one in LOG_SAMPLE_RATE documents at the DEBUG level, or none with 0
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '100'))
+# JSON codec of batch documents: 'auto' uses orjson or msgspec when installed, or 'orjson', 'msgspec' or 'json'
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto')
+# SQLite file of the persistent enrichment task queue
+QUEUE_PATH = os.getenv('QUEUE_PATH', 'queue.sqlite3')
+# Maximum number of pending batches
+QUEUE_CAPACITY = int(os.getenv('QUEUE_CAPACITY', '10000'))
+# Maximum number of attempts of a batch before it is dead-lettered
+MAX_ATTEMPTS = int(os.getenv('MAX_ATTEMPTS', '8'))
+# Base and cap of the exponential retry backoff in seconds
+RETRY_BACKOFF_BASE = float(os.getenv('RETRY_BACKOFF_BASE', '2'))
+RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', '600'))
+# Seconds to remember completed batches, so that redelivered events are ignored
+COMPLETED_RETENTION = float(os.getenv('COMPLETED_RETENTION', str(24 * 60 * 60)))
+# Queue depth from which new batches are rejected with 429 until the workers catch up
+QUEUE_HIGH_WATER_MARK = int(os.getenv('QUEUE_HIGH_WATER_MARK', '1000'))
+# Seconds Discovery is asked to wait before redelivering a rejected batch
+RETRY_AFTER = int(os.getenv('RETRY_AFTER', '60'))
+# Seconds a verified webhook token is trusted without checking its signature again
+WEBHOOK_TOKEN_CACHE_TTL = float(os.getenv('WEBHOOK_TOKEN_CACHE_TTL', '60'))
+# Format of the entities generated by the model: 'text' ("name: type, ...") or 'json'
+LLM_OUTPUT_FORMAT = os.getenv('LLM_OUTPUT_FORMAT', 'text')
+# Number of documents enriched together, so that their texts can share generation requests
+LLM_BATCH_DOCUMENTS = int(os.getenv('LLM_BATCH_DOCUMENTS', '8'))
+# Maximum number of texts packed into one generation request. 1 disables packing.
+LLM_BATCH_MAX_TEXTS = int(os.getenv('LLM_BATCH_MAX_TEXTS', '8'))
+# Maximum estimated number of tokens (prompt and output) of a packed generation request
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv('LLM_BATCH_TOKEN_BUDGET', '4096'))
+# Maximum number of generation requests in flight
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '4'))
+# Timeout of a generation request in seconds
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+# Maximum number of retries of a rate-limited or failed generation request
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '5'))
+# SQLite file of the entity extraction result cache. Empty disables the cache.
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+# Maximum number of cached results. The least recently used ones are evicted first.
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '100000'))
+# Time to live of a cached result in seconds
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 60 * 60)))
+
+# Enrichment task queue. It is opened by open_task_queue() when the workers start, so that importers of this module,
+# such as spawned pool processes and the benchmark, do not create the queue file.
+q = None
 
-# Enrichment task queue
-q = queue.Queue()
+def open_task_queue():
+    global q
+    q = TaskQueue(QUEUE_PATH, QUEUE_CAPACITY, MAX_ATTEMPTS, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, COMPLETED_RETENTION)
+    register_queue_gauges(q)
 
 app = flask.Flask(__name__)
-app.logger.setLevel(logging.INFO)
+app.logger.setLevel(LOG_LEVEL)
 app.logger.handlers[0].setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s (%(filename)s:%(lineno)d)'))
 
-def get_iam_token():
-    data = {'grant_type': 'urn:ibm:params:oauth:grant-type:apikey', 'apikey': IBM_CLOUD_API_KEY}
-    response = requests.post('https://iam.cloud.ibm.com/identity/token', data=data)
-    if response.status_code == 200:
-        return response.json()['access_token']
-    else:
-        raise Exception('Failed to get IAM token.')
+# Number of documents considered for payload logging
+logged_documents = itertools.count()
 
-IAM_TOKEN = None
+def log_payload():
+    """Return whether to log the full payloads of a document.
 
-def extract_entities(text):
-    global IAM_TOKEN
-    if IAM_TOKEN is None:
-        IAM_TOKEN = get_iam_token()
-    # Prompt
-    payload = {
-        'model_id': 'ibm/granite-13b-instruct-v1',
-        'input': f'''Act as a webmaster who must extract structured information from emails. Read the below email and extract and categorize each entity. If no entity is found, output "None".
+    Only one in LOG_SAMPLE_RATE documents is logged, and the counter does not even advance while DEBUG is disabled.
+    """
+    return LOG_SAMPLE_RATE > 0 and app.logger.isEnabledFor(logging.DEBUG) and next(logged_documents) % LOG_SAMPLE_RATE == 0
+
+json_loads, json_dumps = load_codec(JSON_CODEC)
+
+# Pooled keep-alive connections shared by the IAM and WML calls
+http_session = requests.Session()
+http_adapter = requests.adapters.HTTPAdapter(pool_maxsize=LLM_CONCURRENCY + 1)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+class TokenManager:
+    """Keeps an IAM token valid, refreshing it in the background before it expires."""
+
+    retry_interval = 10.0
+
+    def __init__(self, api_key, refresh_margin):
+        self.api_key = api_key
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.refresh_at = 0.0
+        self.refresher = None
+
+    def fetch(self):
+        data = {'grant_type': 'urn:ibm:params:oauth:grant-type:apikey', 'apikey': self.api_key}
+        response = http_session.post(f'{IAM_ENDPOINT_URL}/identity/token', data=data, timeout=30)
+        if response.status_code != 200:
+            raise Exception('Failed to get IAM token.')
+        result = response.json()
+        token = result['access_token']
+        expiration = result.get('expiration')
+        if expiration is None:
+            expiration = jwt.decode(token, options={'verify_signature': False})['exp']
+        now = time.time()
+        # Refresh ahead of the expiration, but not before half of the lifetime has passed
+        self.refresh_at = max(expiration - self.refresh_margin, now + (expiration - now) / 2)
+        self.token = token
+        app.logger.info('Got IAM token expiring in %d seconds', expiration - now)
+
+    def get_token(self):
+        # The lock makes concurrent callers wait for a single refresh instead of stampeding IAM
+        with self.lock:
+            if self.token is None or time.time() >= self.refresh_at:
+                self.fetch()
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self.refresh_periodically, daemon=True)
+                self.refresher.start()
+            return self.token
+
+    def invalidate(self, token):
+        """Drop a token rejected by the server, unless another caller already replaced it."""
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    def refresh_periodically(self):
+        while True:
+            time.sleep(max(self.refresh_at - time.time(), 1.0))
+            with self.lock:
+                if time.time() < self.refresh_at:
+                    continue
+                try:
+                    self.fetch()
+                except Exception as e:
+                    app.logger.warning('Failed to refresh IAM token: %s', e)
+                    self.refresh_at = time.time() + self.retry_interval
+
+token_manager = TokenManager(IBM_CLOUD_API_KEY, IAM_REFRESH_MARGIN)
+
+MODEL_ID = 'ibm/granite-13b-instruct-v1'
+MAX_NEW_TOKENS = 50
+GENERATION_PARAMETERS = {
+    'decoding_method': 'greedy',
+    'min_new_tokens': 1,
+    # Stop as soon as the model starts to make up the next example
+    'stop_sequences': ['\n\n', '\nInput'],
+    'repetition_penalty': 1
+}
+
+# Prompts by output format
+PROMPT_TEMPLATES = {
+    'text': '''Act as a webmaster who must extract structured information from emails. Read the below email and extract and categorize each entity. If no entity is found, output "None".
 
 Input:
 "Golden Bank is a competitor of Silver Bank in the US" said John Doe.
@@ -54,158 +199,465 @@ Input:
 
 Named Entities:
 ''',
-        'parameters': {
-            'decoding_method': 'greedy',
-            'max_new_tokens': 50,
-            'min_new_tokens': 1,
-            'stop_sequences': [],
-            'repetition_penalty': 1
-        },
-        'wml_instance_crn': WML_INSTANCE_CRN
-    }
-    params = {'version': '2023-05-29'}
-    headers = {'Authorization': f'Bearer {IAM_TOKEN}'}
-    response = requests.post(f'{WML_ENDPOINT_URL}/ml/v1-beta/generation/text', json=payload, params=params, headers=headers)
-    if response.status_code == 200:
-        result = response.json()['results'][0]['generated_text']
-        app.logger.info('LLM result: %s', result)
-        entities = []
-        if result == 'None':
-            # No entity found
-            return entities
-        for pair in re.split(r',\s*', result):
-            text_type = re.split(r':\s*', pair)
-            entities.append({'text': text_type[0], 'type': text_type[1]})
-        return entities
-    elif response.status_code == 401:
-        # Token expired. Re-generate it.
-        IAM_TOKEN = get_iam_token()
-        return extract_entities(text)
-    else:
+    'json': '''Act as a webmaster who must extract structured information from emails. Read the below email and extract and categorize each entity. Output the entities as a JSON array of objects with "text" and "type". If no entity is found, output [].
+
+Input:
+"Golden Bank is a competitor of Silver Bank in the US" said John Doe.
+
+Named Entities:
+[{{"text": "Golden Bank", "type": "company"}}, {{"text": "Silver Bank", "type": "company"}}, {{"text": "US", "type": "country"}}, {{"text": "John Doe", "type": "person"}}]
+
+Input:
+{text}
+
+Named Entities:
+''',
+}
+PROMPT_TEMPLATE = PROMPT_TEMPLATES[LLM_OUTPUT_FORMAT]
+
+# Prompts for multiple texts in one generation request by output format
+BATCH_PROMPT_TEMPLATES = {
+    'text': '''Act as a webmaster who must extract structured information from emails. Read each of the below numbered emails and extract and categorize each entity. Output one line per email, starting with its number. If no entity is found in an email, output "None" for it.
+
+Input 1:
+"Golden Bank is a competitor of Silver Bank in the US" said John Doe.
+
+Input 2:
+Thank you for your reply.
+
+Named Entities:
+1. Golden Bank: company, Silver Bank: company, US: country, John Doe: person
+2. None
+
+{inputs}
+Named Entities:
+''',
+    'json': '''Act as a webmaster who must extract structured information from emails. Read each of the below numbered emails and extract and categorize each entity. Output one line per email, starting with its number, with the entities as a JSON array of objects with "text" and "type". If no entity is found in an email, output [] for it.
+
+Input 1:
+"Golden Bank is a competitor of Silver Bank in the US" said John Doe.
+
+Input 2:
+Thank you for your reply.
+
+Named Entities:
+1. [{{"text": "Golden Bank", "type": "company"}}, {{"text": "Silver Bank", "type": "company"}}, {{"text": "US", "type": "country"}}, {{"text": "John Doe", "type": "person"}}]
+2. []
+
+{inputs}
+Named Entities:
+''',
+}
+BATCH_PROMPT_TEMPLATE = BATCH_PROMPT_TEMPLATES[LLM_OUTPUT_FORMAT]
+
+batch_output_line = re.compile(r'^\s*(\d+)\.\s*(.*)$')
+# "name: type" followed by a comma, a newline or the end. The name may contain colons and commas, the type may not, and neither may contain newlines.
+text_entity = re.compile(r'([^\n]*?)\s*:\s*([^,:\r\n]+?)\s*(?:,|\n|$)', re.M)
+json_entity = re.compile(r'\{[^{}]*\}')
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English text
+    return len(text) // 4 + 1
+
+llm_request_seconds = prometheus_client.Histogram('enrichment_llm_request_seconds', 'Seconds of a generation request', buckets=PHASE_BUCKETS)
+llm_requests = prometheus_client.Counter('enrichment_llm_requests_total', 'Generation requests by status code, or error when none was received', ['status'])
+llm_retries = prometheus_client.Counter('enrichment_llm_retries_total', 'Retried generation requests by reason', ['reason'])
+llm_cache_lookups = prometheus_client.Counter('enrichment_llm_cache_lookups_total', 'Entity extraction result cache lookups by result: hit or miss', ['result'])
+
+class GenerationClient:
+    """Generation client that runs up to `concurrency` requests at once and backs off on 429/503 responses."""
+
+    backoff_base = 1.0
+    backoff_max = 60.0
+
+    def __init__(self, concurrency, timeout, max_retries):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='generation')
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+    def map(self, fn, items):
+        """Apply fn to each item concurrently and return the results in order."""
+        return list(self.executor.map(fn, items))
+
+    def backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, float(retry_after))
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, prompt, max_new_tokens):
+        """Return the URL, JSON payload and query parameters of a generation request."""
+        payload = {
+            'model_id': MODEL_ID,
+            'input': prompt,
+            'parameters': {**GENERATION_PARAMETERS, 'max_new_tokens': max_new_tokens},
+            'wml_instance_crn': WML_INSTANCE_CRN
+        }
+        return f'{WML_ENDPOINT_URL}/ml/v1-beta/generation/text', payload, {'version': '2023-05-29'}
+
+    def failed(self, error, attempt):
+        """Return the seconds to wait before retrying a request that got no response, or raise error after the last attempt."""
+        llm_requests.labels('error').inc()
+        if attempt == self.max_retries:
+            raise error
+        llm_retries.labels('connection').inc()
+        app.logger.warning('Generation request failed: %s', error)
+        return self.backoff(attempt)
+
+    def responded(self, response, token, attempt):
+        """Return the result of a response and None, or None and the seconds to wait before retrying.
+
+        Raise if the request failed and is not retried.
+        """
+        llm_requests.labels(response.status_code).inc()
+        if response.status_code == 200:
+            result = response.json()['results'][0]
+            app.logger.debug('LLM result: %s', result['generated_text'])
+            return result, None
+        elif response.status_code == 401 and attempt < self.max_retries:
+            # Token expired. Re-generate it.
+            llm_retries.labels('unauthorized').inc()
+            token_manager.invalidate(token)
+            return None, 0
+        elif response.status_code in (429, 503) and attempt < self.max_retries:
+            llm_retries.labels('throttled').inc()
+            app.logger.warning('Generation request throttled: %d', response.status_code)
+            return None, self.backoff(attempt, response)
         raise Exception(f'Failed to generate: {response.text}')
 
-def enrich(doc):
-    app.logger.info('doc: %s', doc)
-    features_to_send = []
-    for feature in doc['features']:
-        # Target 'text' field
-        if feature['properties']['field_name'] != 'text':
-            continue
-        location = feature['location']
-        begin = location['begin']
-        end = location['end']
-        text = doc['artifact'][begin:end]
+    def generate(self, prompt, max_new_tokens):
+        """Return the generation result, which has 'generated_text' and 'stop_reason'."""
+        url, payload, params = self.request(prompt, max_new_tokens)
+        for attempt in range(self.max_retries + 1):
+            token = token_manager.get_token()
+            headers = {'Authorization': f'Bearer {token}'}
+            try:
+                with llm_request_seconds.time():
+                    response = http_session.post(url, json=payload, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                time.sleep(self.failed(e, attempt))
+                continue
+            result, delay = self.responded(response, token, attempt)
+            if result is not None:
+                return result
+            time.sleep(delay)
+
+generation_client = GenerationClient(LLM_CONCURRENCY, LLM_TIMEOUT, LLM_MAX_RETRIES)
+
+class ResultCache:
+    """Persistent cache of entity extraction results in SQLite, bounded by entry count (LRU) and age."""
+
+    evict_interval = 100
+
+    def __init__(self, path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    @staticmethod
+    def key(text, template):
+        # The result depends on the model, the prompt template it was produced with and the parameters as well as the text.
+        # A packed request has a budget of MAX_NEW_TOKENS per text, like a single one.
+        key = json.dumps([MODEL_ID, template, GENERATION_PARAMETERS, MAX_NEW_TOKENS, text])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, keys):
+        """Return the value of the first of the keys that is cached, or None."""
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                row = self.connection.execute('SELECT value, created FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    self.connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+                    self.hits += 1
+                    llm_cache_lookups.labels('hit').inc()
+                    return json.loads(row[0])
+            self.misses += 1
+            llm_cache_lookups.labels('miss').inc()
+        return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+            self.puts += 1
+            if self.puts % self.evict_interval == 0:
+                self.evict(now)
+
+    def evict(self, now):
+        self.connection.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+        self.connection.execute(
+            'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+            }
+
+# Entity extraction result cache. It is opened by open_result_cache() when the workers start, and stays None if disabled.
+result_cache = None
+
+def open_result_cache():
+    global result_cache
+    if LLM_CACHE_PATH:
+        result_cache = ResultCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL)
+
+def strip_stop_sequences(generated_text):
+    for stop_sequence in GENERATION_PARAMETERS['stop_sequences']:
+        generated_text = generated_text.split(stop_sequence, 1)[0]
+    return generated_text.strip()
+
+def parse_entities(output, truncated=False, text=None):
+    """Parse the entities in the output of the model, salvaging what it can from malformed or truncated output.
+
+    In the text format, "name: type" entities are separated by commas or newlines, so 'Golden Bank: company\nUS: country'
+    gives both entities. A name is glued to the fragments without a type before it, since names may contain commas.
+    Given the text the output was generated from, the longest of the comma-joined candidates that occurs in it is kept,
+    so 'Smith, John: person' gives 'Smith, John', and 'None, foo: bar' gives 'foo' if 'None, foo' is not in the text.
+    Candidates that are empty or start with a colon or comma are dropped, so ' : x, a:b' gives only 'a'.
+    """
+    output = output.strip()
+    if LLM_OUTPUT_FORMAT == 'json':
         try:
-            # Entity extraction example
-            results = extract_entities(text)
-            app.logger.info('entities: %s', results)
-            for entity in results:
-                entity_text = entity['text']
-                entity_type = entity['type']
-                for matched in re.finditer(re.escape(entity_text), text):
-                    features_to_send.append(
-                        {
-                            'type': 'annotation',
-                            'location': {
-                                'begin': matched.start() + begin,
-                                'end': matched.end() + begin,
-                            },
-                            'properties': {
-                                'type': 'entities',
-                                'confidence': 1.0,
-                                'entity_type': entity_type,
-                                'entity_text': matched.group(0),
-                            },
-                        }
-                    )
-        except Exception as e:
-            # Notice example
-            features_to_send.append(
-                {
-                    'type': 'notice',
-                    'properties': {
-                        'description': str(e),
-                        'created': round(time.time() * 1000),
-                    },
-                }
-            )
-    app.logger.info('features_to_send: %s', features_to_send)
-    return {'document_id': doc['document_id'], 'features': features_to_send}
-
-def enrichment_worker():
-    while True:
-        item = q.get()
-        version = item['version']
-        data = item['data']
-        project_id = data['project_id']
-        collection_id = data['collection_id']
-        batch_id = data['batch_id']
-        batch_api = f'{WD_API_URL}/v2/projects/{project_id}/collections/{collection_id}/batches/{batch_id}'
-        params = {'version': version}
-        auth = ('apikey', WD_API_KEY)
-        headers = {'Accept-Encoding': 'gzip'}
+            items = json.loads(output)
+        except ValueError:
+            # Salvage the complete objects of a malformed or truncated array
+            items = []
+            for matched in json_entity.finditer(output):
+                try:
+                    items.append(json.loads(matched.group(0)))
+                except ValueError:
+                    pass
+        if not isinstance(items, list):
+            return []
+        return [
+            {'text': str(item['text']), 'type': str(item['type'])}
+            for item in items
+            if isinstance(item, dict) and item.get('text') and item.get('type')
+        ]
+    if output == 'None':
+        # No entity found
+        return []
+    matches = list(text_entity.finditer(output))
+    if truncated and matches and matches[-1].end() == len(output):
+        # The last entity may have been cut off by max_new_tokens
+        matches.pop()
+    entities = []
+    for matched in matches:
+        name = matched.group(1)
+        # The whole name first, then the parts after each of its commas
+        candidates = [name.strip()] + [name[i + 1:].strip() for i, char in enumerate(name) if char == ',']
+        candidates = [candidate for candidate in candidates if candidate and candidate[0] not in ':,']
+        if candidates:
+            found = next((candidate for candidate in candidates if candidate in text), None) if text is not None else None
+            entities.append({'text': found or candidates[0], 'type': matched.group(2)})
+    return entities
+
+def extract_entities(text):
+    result = generation_client.generate(PROMPT_TEMPLATE.format(text=text), MAX_NEW_TOKENS)
+    return parse_entities(strip_stop_sequences(result['generated_text']), result.get('stop_reason') == 'max_tokens', text)
+
+def pack_texts(texts):
+    """Group the indexes of texts so that each group fits in one generation request."""
+    base_tokens = estimate_tokens(BATCH_PROMPT_TEMPLATE)
+    groups = []
+    group = []
+    group_tokens = base_tokens
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text) + MAX_NEW_TOKENS
+        if group and (len(group) >= LLM_BATCH_MAX_TEXTS or group_tokens + tokens > LLM_BATCH_TOKEN_BUDGET):
+            groups.append(group)
+            group = []
+            group_tokens = base_tokens
+        group.append(i)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def extract_entities_packed(texts):
+    """Extract entities of several texts with one generation request. Missing or truncated outputs are None."""
+    inputs = ''.join(f'Input {i + 1}:\n{text}\n\n' for i, text in enumerate(texts))
+    result = generation_client.generate(BATCH_PROMPT_TEMPLATE.format(inputs=inputs), MAX_NEW_TOKENS * len(texts))
+    lines = strip_stop_sequences(result['generated_text']).splitlines()
+    if lines and result.get('stop_reason') == 'max_tokens':
+        # The last line may have been cut off by max_new_tokens
+        lines.pop()
+    results = [None] * len(texts)
+    for line in lines:
+        matched = batch_output_line.match(line)
+        if matched and 0 < int(matched.group(1)) <= len(texts):
+            results[int(matched.group(1)) - 1] = parse_entities(matched.group(2), text=texts[int(matched.group(1)) - 1])
+    return results
+
+def extract_entities_group(texts):
+    """Extract entities of texts that share one generation request. Return the results and the prompt template that produced each."""
+    results = [None] * len(texts)
+    if len(texts) > 1:
         try:
-            # Get documents from WD
-            response = requests.get(batch_api, params=params, auth=auth, headers=headers, stream=True)
-            status_code = response.status_code
-            app.logger.info('Pulled a batch: %s, status: %d', batch_id, status_code)
-            if status_code == 200:
-                # Annotate documents
-                enriched_docs = [enrich(json.loads(line)) for line in response.iter_lines()]
-                files = {
-                    'file': (
-                        'data.ndjson.gz',
-                        gzip.compress(
-                            '\n'.join(
-                                [json.dumps(enriched_doc) for enriched_doc in enriched_docs]
-                            ).encode('utf-8')
-                        ),
-                        'application/x-ndjson'
-                    )
-                }
-                # Upload annotated documents
-                response = requests.post(batch_api, params=params, files=files, auth=auth)
-                status_code = response.status_code
-                app.logger.info('Pushed a batch: %s, status: %d', batch_id, status_code)
+            results = extract_entities_packed(texts)
         except Exception as e:
-            app.logger.error('An error occurred: %s', e, exc_info=True)
-            # Retry
-            q.put(item)
+            app.logger.warning('Failed to generate for %d texts at once: %s', len(texts), e)
+    templates = [BATCH_PROMPT_TEMPLATE] * len(texts)
+    for i, text in enumerate(texts):
+        if results[i] is None:
+            # Not packed, or the packed output for the text is missing
+            templates[i] = PROMPT_TEMPLATE
+            try:
+                results[i] = extract_entities(text)
+            except Exception as e:
+                results[i] = e
+    return results, templates
 
-# Turn on the enrichment worker thread
-threading.Thread(target=enrichment_worker, daemon=True).start()
+def extract_entities_batch(texts):
+    """Extract entities of each text. Each result is either a list of entities or the exception raised for it."""
+    results = [None] * len(texts)
+    if result_cache is not None:
+        for i, text in enumerate(texts):
+            # Results of single and packed requests are both accepted
+            results[i] = result_cache.get([ResultCache.key(text, PROMPT_TEMPLATE), ResultCache.key(text, BATCH_PROMPT_TEMPLATE)])
+    missing = [i for i, entities in enumerate(results) if entities is None]
+    groups = pack_texts([texts[i] for i in missing])
+    # Send the generation requests of the groups concurrently
+    group_results = generation_client.map(lambda group: extract_entities_group([texts[missing[j]] for j in group]), groups)
+    for group, (entities_list, templates) in zip(groups, group_results):
+        for j, entities, template in zip(group, entities_list, templates):
+            i = missing[j]
+            results[i] = entities
+            if result_cache is not None and not isinstance(entities, Exception):
+                result_cache.put(ResultCache.key(texts[i], template), entities)
+    return results
+
+def enrich_docs(docs):
+    # Collect the target texts of all documents, so that they share generation requests
+    segments = []
+    logged = [log_payload() for _ in docs]
+    for doc_index, doc in enumerate(docs):
+        if logged[doc_index]:
+            app.logger.debug('doc: %s', doc)
+        for feature in doc['features']:
+            # Target 'text' field
+            if feature['properties']['field_name'] != 'text':
+                continue
+            location = feature['location']
+            begin = location['begin']
+            end = location['end']
+            segments.append((doc_index, begin, doc['artifact'][begin:end]))
+    results = extract_entities_batch([text for _, _, text in segments])
+    features_by_doc = [FeatureBuffer(doc['document_id']) for doc in docs]
+    # Entity type -> properties shared by its annotations
+    entity_properties = {}
+    for (doc_index, begin, text), entities in zip(segments, results):
+        features_to_send = features_by_doc[doc_index]
+        if isinstance(entities, Exception):
+            # Notice example
+            features_to_send.notice(str(entities), round(time.time() * 1000))
+            continue
+        # Entity extraction example
+        if logged[doc_index]:
+            app.logger.debug('entities: %s', entities)
+        # Locate all the entities in one pass, without duplicates or overlaps
+        matcher = EntityMatcher((entity['text'], entity['type']) for entity in entities)
+        for entity_begin, entity_end, entity_type in matcher.find(text):
+            properties = entity_properties.get(entity_type)
+            if properties is None:
+                properties = entity_properties[entity_type] = {'type': 'entities', 'confidence': 1.0, 'entity_type': entity_type}
+            features_to_send.annotation(entity_begin + begin, entity_end + begin, properties, text[entity_begin:entity_end])
+    for doc_index, features_to_send in enumerate(features_by_doc):
+        app.logger.debug('Enriched a document: %s, features: %d', features_to_send.document_id, len(features_to_send))
+        if logged[doc_index]:
+            app.logger.debug('features_to_send: %s', features_to_send)
+    return features_by_doc
+
+def enrich(doc):
+    return enrich_docs([doc])[0]
+
+def enrich_stream(lines, stats=None):
+    """Yield the enriched lines of a batch. stats, a BatchStats, counts documents and features."""
+    stats = stats or BatchStats()
+    lines = iter(lines)
+    while chunk := list(itertools.islice(lines, LLM_BATCH_DOCUMENTS)):
+        with stats.phase('parse'):
+            docs = [json_loads(line) for line in chunk]
+        for features_to_send in enrich_docs(docs):
+            stats.documents += 1
+            stats.features += len(features_to_send)
+            yield features_to_send.encode(json_dumps)
+
+def enrich_lines(lines):
+    """Return the enriched lines of a chunk of documents and their number of features."""
+    features_by_doc = enrich_docs([json_loads(line) for line in lines])
+    return [features_to_send.encode(json_dumps) for features_to_send in features_by_doc], sum(len(features_to_send) for features_to_send in features_by_doc)
+
+# Uploads of a worker run while its download is still open
+discovery_client = DiscoveryBatchClient(WD_API_URL, WD_API_KEY, ENRICHMENT_WORKERS * 2, (WD_CONNECT_TIMEOUT, WD_READ_TIMEOUT), WD_MAX_RETRIES)
+
+def start_enrichment_workers():
+    open_task_queue()
+    open_result_cache()
+    q.recover()
+    for _ in range(ENRICHMENT_WORKERS):
+        threading.Thread(target=batch_worker.enrichment_worker, args=(q, discovery_client, enrich_stream, STREAMING, app.logger), daemon=True).start()
+
+# Cache statistics endpoint
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    if result_cache is None:
+        return {'enabled': False}
+    return {'enabled': True, **result_cache.stats()}
+
+# Metrics endpoint in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return prometheus_client.generate_latest(), 200, {'Content-Type': prometheus_client.CONTENT_TYPE_LATEST}
+
+# Health endpoint. Reports 503 while the queue is over the high-water mark, so that load balancers shed load.
+@app.route('/health', methods=['GET'])
+def health():
+    stats = q.stats()
+    if stats['depth'] >= QUEUE_HIGH_WATER_MARK:
+        return {'status': 'overloaded', 'queue': stats}, 503, {'Retry-After': str(RETRY_AFTER)}
+    return {'status': 'ok', 'queue': stats}, 200, {}
+
+webhook_verifier = WebhookVerifier(WEBHOOK_SECRET, WEBHOOK_TOKEN_CACHE_TTL)
 
 # Webhook endpoint
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    return handle_webhook(flask.request.headers.get('Authorization'), flask.request.data)
+
+def handle_webhook(authorization, data):
+    """Verify the Authorization header of a webhook request, process its event and return the body, status code and headers of the response."""
     # Verify JWT token
-    header = flask.request.headers.get('Authorization')
-    _, token = header.split()
     try:
-        jwt.decode(token, WEBHOOK_SECRET, algorithms=['HS256'])
+        cached = webhook_verifier.verify(authorization)
     except jwt.PyJWTError as e:
+        webhook_auth.labels('rejected').inc()
         app.logger.error('Invalid token: %s', e)
-        return {'status': 'unauthorized'}, 401
+        return {'status': 'unauthorized'}, 401, {}
+    webhook_auth.labels('cached' if cached else 'verified').inc()
     # Process webhook event
-    data = flask.json.loads(flask.request.data)
-    app.logger.info('Received event: %s', data)
-    event = data['event']
-    if event == 'ping':
-        # Receive this event when a webhook enrichment is created
-        code = 200
-        status = 'ok'
-    elif event == 'enrichment.batch.created':
-        # Receive this event when a batch of the documents gets ready
-        code = 202
-        status = 'accepted'
-        # Put an enrichment request into the queue
-        q.put(data)
-    else:
-        # Unknown event type
-        code = 400
-        status = 'bad request'
-    return {'status': status}, code
+    return batch_worker.handle_event(q, json_loads(data), QUEUE_HIGH_WATER_MARK, RETRY_AFTER, app.logger)
 
 PORT = os.getenv('PORT', '8080')
 if __name__ == '__main__':
+    # Turn on the enrichment worker threads. They are not started on import, so that the async server in asgi.py,
+    # which imports this module, does not run them.
+    start_enrichment_workers()
     app.run(host='0.0.0.0', port=int(PORT))
@@ -0,0 +1,145 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+
+class QueueFullError(Exception):
+    pass
+
+class TaskQueue:
+    """Persistent enrichment task queue in SQLite.
+
+    Batches are tracked by batch_id, so redelivered events of pending or completed batches are ignored.
+    Failed batches are retried with exponential backoff and jitter, and are dead-lettered after max_attempts.
+    Collections are served in round-robin order.
+    """
+
+    def __init__(self, path, capacity, max_attempts, backoff_base, backoff_max, retention):
+        self.capacity = capacity
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention = retention
+        self.condition = threading.Condition()
+        # Collection -> the number of tasks it had served when it was last served
+        self.served = {}
+        self.serial = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'batch_id TEXT PRIMARY KEY, collection TEXT NOT NULL, item TEXT NOT NULL, state TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL, next_attempt REAL NOT NULL, updated REAL NOT NULL, error TEXT, enqueued REAL NOT NULL)'
+        )
+        if 'enqueued' not in {row[1] for row in self.connection.execute('PRAGMA table_info(tasks)')}:
+            # Queue files of earlier versions lack the enqueue time, which updated approximates
+            self.connection.execute('ALTER TABLE tasks ADD COLUMN enqueued REAL NOT NULL DEFAULT 0')
+            self.connection.execute('UPDATE tasks SET enqueued = updated')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, next_attempt)')
+        # Number of pending and running batches, and of running batches
+        self.depth = self.connection.execute("SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'running')").fetchone()[0]
+        self.in_flight = 0
+
+    def recover(self):
+        """Requeue the tasks that were running when the process stopped."""
+        with self.condition:
+            self.connection.execute("UPDATE tasks SET state = 'pending' WHERE state = 'running'")
+
+    def put(self, item):
+        """Queue a batch. Return False if the batch is already pending or completed."""
+        data = item['data']
+        batch_id = data['batch_id']
+        collection = f'{data["project_id"]}/{data["collection_id"]}'
+        now = time.time()
+        with self.condition:
+            row = self.connection.execute('SELECT state FROM tasks WHERE batch_id = ?', (batch_id,)).fetchone()
+            if row is not None and row[0] != 'dead':
+                return False
+            if self.depth >= self.capacity:
+                raise QueueFullError(f'{self.capacity} batches are pending')
+            self.connection.execute(
+                'INSERT OR REPLACE INTO tasks (batch_id, collection, item, state, attempts, next_attempt, updated, error, enqueued) '
+                "VALUES (?, ?, ?, 'pending', 0, ?, ?, NULL, ?)",
+                (batch_id, collection, json.dumps(item), now, now, now)
+            )
+            self.depth += 1
+            self.condition.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Wait for a batch that is ready to run, and mark it as running. Return None if none is ready within timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                ready = self.connection.execute(
+                    "SELECT DISTINCT collection FROM tasks WHERE state = 'pending' AND next_attempt <= ?", (now,)
+                ).fetchall()
+                if ready:
+                    # Serve the collection that has waited the longest since it was last served
+                    collection = min((row[0] for row in ready), key=lambda c: self.served.get(c, -1))
+                    self.serial += 1
+                    self.served[collection] = self.serial
+                    batch_id, item = self.connection.execute(
+                        "SELECT batch_id, item FROM tasks WHERE state = 'pending' AND collection = ? AND next_attempt <= ? ORDER BY rowid LIMIT 1",
+                        (collection, now)
+                    ).fetchone()
+                    self.connection.execute("UPDATE tasks SET state = 'running', updated = ? WHERE batch_id = ?", (now, batch_id))
+                    self.in_flight += 1
+                    return json.loads(item)
+                next_attempt = self.connection.execute("SELECT MIN(next_attempt) FROM tasks WHERE state = 'pending'").fetchone()[0]
+                wait = None if next_attempt is None else next_attempt - now
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+
+    def done(self, item):
+        now = time.time()
+        with self.condition:
+            self.connection.execute("UPDATE tasks SET state = 'done', updated = ?, error = NULL WHERE batch_id = ?", (now, item['data']['batch_id']))
+            self.depth -= 1
+            self.in_flight -= 1
+            # Completed batches are kept for a while to ignore redelivered events
+            self.connection.execute("DELETE FROM tasks WHERE state = 'done' AND updated < ?", (now - self.retention,))
+
+    def fail(self, item, error):
+        """Schedule a retry of a failed batch with backoff, or dead-letter it after max_attempts."""
+        batch_id = item['data']['batch_id']
+        now = time.time()
+        with self.condition:
+            attempts = self.connection.execute('SELECT attempts FROM tasks WHERE batch_id = ?', (batch_id,)).fetchone()[0] + 1
+            self.in_flight -= 1
+            if attempts >= self.max_attempts:
+                state = 'dead'
+                next_attempt = now
+                self.depth -= 1
+            else:
+                state = 'pending'
+                # Exponential backoff with full jitter
+                next_attempt = now + random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempts))
+            self.connection.execute(
+                'UPDATE tasks SET state = ?, attempts = ?, next_attempt = ?, updated = ?, error = ? WHERE batch_id = ?',
+                (state, attempts, next_attempt, now, str(error), batch_id)
+            )
+            self.condition.notify()
+            return state
+
+    def qsize(self):
+        return self.depth
+
+    def stats(self):
+        """Return the queue depth, the number of running batches and how long the oldest pending batch has waited.
+
+        The wait counts from when the batch was queued, so it includes the failed attempts and backoff of a retried batch.
+        """
+        with self.condition:
+            oldest = self.connection.execute("SELECT MIN(enqueued) FROM tasks WHERE state = 'pending'").fetchone()[0]
+            return {
+                'depth': self.depth,
+                'in_flight': self.in_flight,
+                'lag': 0.0 if oldest is None else round(time.time() - oldest, 3),
+            }
@@ -0,0 +1,48 @@
+import collections
+import hashlib
+import jwt
+import threading
+import time
+
+class WebhookVerifier:
+    """Verifies the JWT bearer tokens in the Authorization headers of webhook requests.
+
+    Tokens that pass are cached for up to ttl seconds, but not beyond their exp claim, so that redelivered
+    and repeated requests skip the signature check. Cache entries are keyed by a digest of the token, and
+    malformed headers are rejected before any decoding.
+    It has no dependency on the webhook application, so other samples can reuse it as is.
+    """
+
+    def __init__(self, secret, ttl=60.0, max_entries=1024, algorithms=('HS256',)):
+        self.key = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.algorithms = list(algorithms)
+        self.decoder = jwt.PyJWT()
+        self.lock = threading.Lock()
+        # Token digest -> time until which the token is valid, in least recently used order
+        self.cache = collections.OrderedDict()
+
+    def verify(self, header):
+        """Verify the Authorization header. Return True if the token was cached, and raise jwt.PyJWTError if it is invalid."""
+        scheme, _, token = (header or '').partition(' ')
+        if scheme.lower() != 'bearer' or token.count('.') != 2:
+            raise jwt.InvalidTokenError('Missing or malformed Authorization header')
+        digest = hashlib.sha256(token.encode('utf-8')).digest()
+        now = time.time()
+        with self.lock:
+            valid_until = self.cache.get(digest)
+            if valid_until is not None:
+                if valid_until > now:
+                    self.cache.move_to_end(digest)
+                    return True
+                del self.cache[digest]
+        claims = self.decoder.decode(token, self.key, algorithms=self.algorithms)
+        valid_until = now + self.ttl
+        if isinstance(claims.get('exp'), (int, float)):
+            valid_until = min(valid_until, claims['exp'])
+        with self.lock:
+            self.cache[digest] = valid_until
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return False
@@ -0,0 +1,31 @@
+import filecmp
+import os
+import sys
+
+SAMPLES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = ['regex', 'granite']
+# Modules that each sample carries an identical copy of, because each sample is built from its own directory
+SHARED_MODULES = [
+    'async_batch_worker.py',
+    'batch_client.py',
+    'batch_stats.py',
+    'batch_worker.py',
+    'features.py',
+    'task_queue.py',
+    'webhook_verifier.py',
+]
+
+def diverged_modules():
+    """Return the shared modules whose copies in the samples differ or are missing."""
+    diverged = []
+    for name in SHARED_MODULES:
+        paths = [os.path.join(SAMPLES_DIR, sample, name) for sample in SAMPLES]
+        if not all(os.path.exists(path) for path in paths) or not all(filecmp.cmp(paths[0], path, shallow=False) for path in paths[1:]):
+            diverged.append(name)
+    return diverged
+
+if __name__ == '__main__':
+    diverged = diverged_modules()
+    for name in diverged:
+        print(f'{name} differs between {" and ".join(SAMPLES)}. Copy the edited one to the other sample.')
+    sys.exit(1 if diverged else 0)
@@ -0,0 +1,115 @@
+import flask
+import gzip
+import json
+import jwt
+import logging
+import re
+import requests
+import threading
+import time
+import werkzeug.serving
+
+# Entities the mock LLM finds in the texts
+MAKES = {'FORD', 'TOYOTA', 'JEEP', 'HONDA', 'CHEVROLET', 'DODGE', 'NISSAN', 'BMW'}
+entity_pattern = re.compile(r'\b(?:\d{4}|[A-Z]{2,})\b')
+single_input = re.compile(r'Input:\n(.*?)\n\n', re.DOTALL)
+numbered_input = re.compile(r'Input (\d+):\n(.*?)\n\n', re.DOTALL)
+
+class FakeDiscovery:
+    """In-memory stand-in for the Discovery batch API, and for the WML and IAM APIs used by the granite sample.
+
+    Batches are added with add_batch() and announced to the webhook with emit(). Uploaded batches are
+    decompressed and counted, and wait_uploads() blocks until the expected ones have arrived.
+    """
+
+    def __init__(self, webhook_url, webhook_secret, llm_latency=0.0):
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.llm_latency = llm_latency
+        self.condition = threading.Condition()
+        # batch_id -> gzip-compressed NDJSON of the documents
+        self.batches = {}
+        # batch_id -> (monotonic time of the upload, number of enriched documents)
+        self.uploads = {}
+        self.server = None
+        self.app = flask.Flask(__name__)
+        self.app.add_url_rule('/v2/projects/<project_id>/collections/<collection_id>/batches/<batch_id>', 'batch', self.batch, methods=['GET', 'POST'])
+        self.app.add_url_rule('/identity/token', 'token', self.token, methods=['POST'])
+        self.app.add_url_rule('/ml/v1-beta/generation/text', 'generate', self.generate, methods=['POST'])
+
+    def add_batch(self, batch_id, docs):
+        self.batches[batch_id] = gzip.compress(b''.join(json.dumps(doc).encode('utf-8') + b'\n' for doc in docs))
+
+    def emit(self, batch_id, project_id='loadtest', collection_id='loadtest'):
+        """Send the enrichment.batch.created event of a batch and return the response."""
+        token = jwt.encode({'iat': int(time.time())}, self.webhook_secret, algorithm='HS256')
+        event = {
+            'event': 'enrichment.batch.created',
+            'version': '2023-03-31',
+            'data': {'project_id': project_id, 'collection_id': collection_id, 'batch_id': batch_id},
+        }
+        return requests.post(self.webhook_url, json=event, headers={'Authorization': f'Bearer {token}'}, timeout=30)
+
+    def wait_uploads(self, batch_ids, timeout):
+        """Wait until all the batches are uploaded and return their uploads."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not all(batch_id in self.uploads for batch_id in batch_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return {batch_id: self.uploads[batch_id] for batch_id in batch_ids if batch_id in self.uploads}
+
+    def batch(self, project_id, collection_id, batch_id):
+        data = self.batches.get(batch_id)
+        if data is None:
+            return {'error': 'not found'}, 404
+        if flask.request.method == 'GET':
+            if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+                return data, 200, {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'}
+            return gzip.decompress(data), 200, {'Content-Type': 'application/x-ndjson'}
+        lines = gzip.decompress(flask.request.files['file'].read()).splitlines()
+        documents = sum(1 for line in lines if 'document_id' in json.loads(line))
+        with self.condition:
+            self.uploads[batch_id] = (time.monotonic(), documents)
+            self.condition.notify_all()
+        return {}, 202
+
+    def token(self):
+        expiration = int(time.time()) + 3600
+        return {'access_token': jwt.encode({'exp': expiration}, 'fake-iam-signing-key-of-32-bytes'), 'expiration': expiration}
+
+    def generate(self):
+        time.sleep(self.llm_latency)
+        prompt = flask.request.json['input']
+        json_format = 'JSON array' in prompt
+        # The prompt is the instructions and examples, the example output and the inputs, and an empty output
+        inputs = prompt.split('Named Entities:\n')[1]
+        texts = [text for _, text in numbered_input.findall(inputs)]
+        if texts:
+            lines = [f'{i + 1}. {self.entities(text, json_format)}' for i, text in enumerate(texts)]
+            generated_text = '\n'.join(lines)
+        else:
+            generated_text = self.entities(single_input.search(inputs).group(1), json_format)
+        return {'results': [{'generated_text': generated_text, 'stop_reason': 'eos_token'}]}
+
+    @staticmethod
+    def entities(text, json_format):
+        found = {}
+        for word in entity_pattern.findall(text):
+            if word.isdigit():
+                found[word] = 'year'
+            elif word in MAKES:
+                found[word] = 'company'
+        if json_format:
+            return json.dumps([{'text': name, 'type': entity_type} for name, entity_type in found.items()])
+        return ', '.join(f'{name}: {entity_type}' for name, entity_type in found.items()) or 'None'
+
+    def start(self, port):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = werkzeug.serving.make_server('127.0.0.1', port, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
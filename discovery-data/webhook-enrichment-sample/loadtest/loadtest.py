@@ -0,0 +1,182 @@
+import argparse
+import collections
+import csv
+import os
+import random
+import requests
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from check_shared import diverged_modules
+from fake_discovery import FakeDiscovery, MAKES
+
+SAMPLES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = 'loadtest-webhook-secret-of-32-bytes'
+WORDS = ['ENGINE', 'TRANSMISSION', 'SLIPS', 'BRAKES', 'FAILED', 'WHILE', 'DRIVING', 'ON', 'THE', 'HIGHWAY', 'AIR', 'BAG', 'DID', 'NOT', 'DEPLOY']
+
+def load_texts(path, repeat):
+    """Return the texts of the documents, from a CSV file with a text column or synthetic ones."""
+    if path:
+        with open(path, newline='', encoding='utf-8') as f:
+            return [' '.join([row['text']] * repeat) for row in csv.DictReader(f)]
+    rng = random.Random(0)
+    texts = []
+    for _ in range(100):
+        sentences = []
+        for _ in range(repeat):
+            words = rng.choices(WORDS, k=rng.randint(5, 15))
+            words.insert(rng.randrange(len(words)), f'{rng.randint(1990, 2023)} {rng.choice(sorted(MAKES))}')
+            sentences.append(' '.join(words) + '.')
+        texts.append(' '.join(sentences))
+    return texts
+
+def make_batch(batch_index, documents, texts):
+    docs = []
+    for i in range(documents):
+        text = texts[(batch_index * documents + i) % len(texts)]
+        docs.append({
+            'document_id': f'{batch_index}-{i}',
+            'artifact': text,
+            'features': [
+                {
+                    'type': 'field',
+                    'location': {'begin': 0, 'end': len(text)},
+                    'properties': {'field_name': 'text'},
+                }
+            ],
+        })
+    return docs
+
+def peak_rss(pid):
+    """Return the peak resident set size in bytes of a process and its descendants, or None without /proc."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+        children = []
+        for tid in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{tid}/children') as f:
+                children += f.read().split()
+    except (OSError, StopIteration):
+        return None
+    return peak + sum(peak_rss(int(child)) or 0 for child in children)
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    values = sorted(values)
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+def start_sample(args, workdir):
+    env = dict(
+        os.environ,
+        PORT=str(args.app_port),
+        WD_API_URL=f'http://127.0.0.1:{args.port}',
+        WD_API_KEY='loadtest',
+        WEBHOOK_SECRET=WEBHOOK_SECRET,
+        QUEUE_PATH=os.path.join(workdir, 'queue.sqlite3'),
+        LOG_LEVEL='WARNING',
+        # Mocked WML and IAM endpoints of the granite sample, without the cache that would skip them
+        IBM_CLOUD_API_KEY='loadtest',
+        WML_ENDPOINT_URL=f'http://127.0.0.1:{args.port}',
+        WML_INSTANCE_CRN='loadtest',
+        IAM_ENDPOINT_URL=f'http://127.0.0.1:{args.port}',
+        LLM_CACHE_PATH='',
+    )
+    for setting in args.env:
+        name, _, value = setting.partition('=')
+        env[name] = value
+    log = open(os.path.join(workdir, 'sample.log'), 'w')
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(args.app_port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, 'main.py']
+    process = subprocess.Popen(command, cwd=os.path.join(SAMPLES_DIR, args.sample), env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    # Wait for the sample to listen
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            requests.get(f'http://127.0.0.1:{args.app_port}/health', timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f'The {args.sample} sample did not start. See {log.name}')
+
+def send_events(discovery, batch_ids, rate):
+    """Announce the batches at the rate, redelivering rejected events after a second.
+
+    Return the first send times, the number of rejected events and the response times of the webhook.
+    """
+    sent = {}
+    rejected = 0
+    response_times = []
+    start = time.monotonic()
+    # (due time, batch_id) in order of the due time
+    pending = collections.deque((start + i / rate, batch_id) for i, batch_id in enumerate(batch_ids))
+    while pending:
+        due, batch_id = pending.popleft()
+        time.sleep(max(0.0, due - time.monotonic()))
+        sent.setdefault(batch_id, time.monotonic())
+        start_time = time.monotonic()
+        response = discovery.emit(batch_id)
+        response_times.append(time.monotonic() - start_time)
+        if response.status_code in (429, 503):
+            rejected += 1
+            pending.append((time.monotonic() + 1.0, batch_id))
+        elif response.status_code != 202:
+            raise SystemExit(f'The webhook responded with status {response.status_code}: {response.text}')
+    return sent, rejected, response_times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay batches through a webhook enrichment sample against a local stand-in of Discovery.')
+    parser.add_argument('sample', choices=['regex', 'granite'])
+    parser.add_argument('--server', choices=['flask', 'asgi'], default='flask', help='run main.py, or asgi.py with uvicorn')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--documents', type=int, default=100, help='number of documents per batch')
+    parser.add_argument('--rate', type=float, default=1.0, help='batches announced per second')
+    parser.add_argument('--data', help='CSV file with a text column, such as ../regex/data/nhtsa.csv. Synthetic texts by default.')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times the text of each row, or synthetic sentences, make up a document')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds the mocked WML endpoint takes per request')
+    parser.add_argument('--port', type=int, default=8090, help='port of the Discovery, WML and IAM stand-in')
+    parser.add_argument('--app-port', type=int, default=8091, help='port of the sample')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the uploads')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='setting of the sample, such as ENRICHMENT_POOL=process')
+    args = parser.parse_args()
+
+    # The samples must run the same shared modules, or the load test would compare different code
+    diverged = diverged_modules()
+    if diverged:
+        sys.exit(f'The copies of {", ".join(diverged)} differ between the samples. Run check_shared.py for details.')
+
+    texts = load_texts(args.data, args.repeat)
+    discovery = FakeDiscovery(f'http://127.0.0.1:{args.app_port}/webhook', WEBHOOK_SECRET, args.llm_latency)
+    batch_ids = [f'batch-{i}' for i in range(args.batches)]
+    for i, batch_id in enumerate(batch_ids):
+        discovery.add_batch(batch_id, make_batch(i, args.documents, texts))
+    discovery.start(args.port)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        process = start_sample(args, workdir)
+        try:
+            sent, rejected, response_times = send_events(discovery, batch_ids, args.rate)
+            uploads = discovery.wait_uploads(batch_ids, args.timeout)
+            rss = peak_rss(process.pid)
+        finally:
+            # Also stop the pool processes of the sample
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            discovery.stop()
+
+    if not uploads:
+        raise SystemExit('No batch was uploaded')
+    documents = sum(count for _, count in uploads.values())
+    elapsed = max(uploaded for uploaded, _ in uploads.values()) - min(sent.values())
+    latencies = [uploaded - sent[batch_id] for batch_id, (uploaded, _) in uploads.items()]
+    print(f'{args.sample} ({args.server}): {len(uploads)} of {args.batches} batches, {documents} documents in {elapsed:.1f} seconds')
+    print(f'  throughput  {documents / elapsed:10.1f} docs/sec')
+    print(f'  latency     p50 {percentile(latencies, 50):.3f} s, p99 {percentile(latencies, 99):.3f} s')
+    print(f'  peak RSS    {"n/a" if rss is None else f"{rss / 2 ** 20:.1f} MB"}')
+    print(f'  webhook     p50 {percentile(response_times, 50) * 1000:.1f} ms, p99 {percentile(response_times, 99) * 1000:.1f} ms')
+    print(f'  rejected    {rejected} events')
@@ -0,0 +1,68 @@
+import asyncio
+import collections
+import contextlib
+import fastapi
+
+import main
+from async_batch_worker import AsyncDiscoveryBatchClient, collect, dispatch_batches
+
+# Async server of the webhook enrichment. Run it with `uvicorn asgi:app --host 0.0.0.0 --port 8080`.
+# It serves the same endpoints as main.py, and one event loop multiplexes the batch downloads and uploads,
+# while the CPU-bound enrichment runs in the process pool (ENRICHMENT_POOL=process) or in threads.
+
+logger = main.app.logger
+
+discovery_client = AsyncDiscoveryBatchClient(main.WD_API_URL, main.WD_API_KEY, main.ENRICHMENT_WORKERS * 2, (main.WD_CONNECT_TIMEOUT, main.WD_READ_TIMEOUT), main.WD_MAX_RETRIES)
+
+async def enrich_stream(lines, stats):
+    """Yield the enriched lines of a batch, enriching chunks of documents in the pool with a bounded number in flight."""
+    loop = asyncio.get_running_loop()
+    pending = collections.deque()
+    chunk = []
+    async for line in lines:
+        if line:
+            chunk.append(line)
+        if len(chunk) == main.ENRICHMENT_CHUNK_SIZE:
+            pending.append(loop.run_in_executor(main.enrichment_pool, main.enrich_lines, chunk))
+            chunk = []
+            if len(pending) > main.ENRICHMENT_WORKERS:
+                for enriched_line in await collect(pending.popleft(), stats):
+                    yield enriched_line
+    if chunk:
+        pending.append(loop.run_in_executor(main.enrichment_pool, main.enrich_lines, chunk))
+    while pending:
+        for enriched_line in await collect(pending.popleft(), stats):
+            yield enriched_line
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    main.start_enrichment_pool()
+    main.open_task_queue()
+    main.q.recover()
+    dispatcher = asyncio.create_task(dispatch_batches(main.q, discovery_client, enrich_stream, main.ENRICHMENT_WORKERS, main.STREAMING, logger))
+    logger.info('Started %d enrichment workers (%s pool, async server)', main.ENRICHMENT_WORKERS, main.ENRICHMENT_POOL)
+    yield
+    dispatcher.cancel()
+    await asyncio.gather(dispatcher, return_exceptions=True)
+    await discovery_client.aclose()
+    if main.enrichment_pool is not None:
+        main.enrichment_pool.shutdown(cancel_futures=True)
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+# The endpoints serve the responses of the handlers of main.py
+
+# Metrics endpoint in the Prometheus text format
+@app.get('/metrics')
+def metrics():
+    return fastapi.Response(*main.metrics())
+
+# Health endpoint. Reports 503 while the queue is over the high-water mark, so that load balancers shed load.
+@app.get('/health')
+def health():
+    return fastapi.responses.JSONResponse(*main.health())
+
+# Webhook endpoint
+@app.post('/webhook')
+async def webhook(request: fastapi.Request):
+    return fastapi.responses.JSONResponse(*main.handle_webhook(request.headers.get('Authorization'), await request.body()))
@@ -0,0 +1,166 @@
+import asyncio
+import concurrent.futures
+import gzip
+import httpx
+import uuid
+import zlib
+
+from batch_stats import BatchStats, batch_errors, batch_retries, batches_dead, batches_pulled, batches_pushed
+
+class AsyncDiscoveryBatchClient:
+    """Async client of the Discovery batch API over pooled keep-alive connections.
+
+    Like DiscoveryBatchClient, downloads are retried on connection errors and 429/5xx responses, and uploads are not.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+    backoff_factor = 0.5
+
+    def __init__(self, api_url, api_key, max_connections, timeout, max_retries):
+        self.api_url = api_url
+        self.max_retries = max_retries
+        connect_timeout, read_timeout = timeout
+        # Unlike requests, httpx rejects a missing API key already here, before any request is made
+        self.client = httpx.AsyncClient(
+            auth=('apikey', api_key or ''),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections)
+        )
+
+    def batch_api(self, item):
+        data = item['data']
+        return f'{self.api_url}/v2/projects/{data["project_id"]}/collections/{data["collection_id"]}/batches/{data["batch_id"]}'
+
+    async def get_batch(self, item):
+        """Return the streamed response of a batch download. The caller must close it."""
+        request = self.client.build_request('GET', self.batch_api(item), params={'version': item['version']}, headers={'Accept-Encoding': 'gzip'})
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.send(request, stream=True)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in self.retry_statuses or attempt == self.max_retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def post_batch(self, item, **kwargs):
+        return await self.client.post(self.batch_api(item), params={'version': item['version']}, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+async def timed(stats, name, lines):
+    """Async version of BatchStats.timed()."""
+    iterator = aiter(lines)
+    while True:
+        with stats.phase(name):
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+        yield item
+
+async def collect(future, stats):
+    """Return the enriched lines of a chunk that future resolves to, and count them in stats."""
+    enriched_lines, features = await future
+    stats.documents += len(enriched_lines)
+    stats.features += features
+    return enriched_lines
+
+async def gzip_ndjson(lines):
+    # wbits=31 produces the gzip container format
+    compressor = zlib.compressobj(wbits=31)
+    separator = b''
+    async for line in lines:
+        chunk = compressor.compress(separator + line)
+        separator = b'\n'
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+async def multipart_stream(boundary, chunks):
+    yield (
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="file"; filename="data.ndjson.gz"\r\n'
+        'Content-Type: application/x-ndjson\r\n\r\n'
+    ).encode('utf-8')
+    async for chunk in chunks:
+        yield chunk
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+async def enrich_batch(q, client, item, enrich_stream, streaming, logger):
+    """Pull, enrich and push a batch with the AsyncDiscoveryBatchClient client, and mark it done or failed in the TaskQueue q."""
+    batch_id = item['data']['batch_id']
+    stats = BatchStats()
+    try:
+        # Get documents from WD
+        with stats.phase('download'):
+            response = await client.get_batch(item)
+        try:
+            status_code = response.status_code
+            batches_pulled.labels(status_code).inc()
+            logger.info('Pulled a batch: %s, status: %d', batch_id, status_code)
+            if status_code == 200:
+                # Annotate documents
+                enriched_lines = timed(stats, 'enrich', enrich_stream(timed(stats, 'download', response.aiter_lines()), stats))
+                if streaming:
+                    # Upload annotated documents while the batch is still being downloaded and enriched
+                    boundary = uuid.uuid4().hex
+                    body = multipart_stream(boundary, timed(stats, 'compress', gzip_ndjson(enriched_lines)))
+                    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+                    with stats.phase('upload'):
+                        upload = await client.post_batch(item, content=body, headers=headers)
+                else:
+                    lines = [line async for line in enriched_lines]
+                    with stats.phase('compress'):
+                        data = await asyncio.to_thread(gzip.compress, b'\n'.join(lines))
+                    files = {'file': ('data.ndjson.gz', data, 'application/x-ndjson')}
+                    # Upload annotated documents
+                    with stats.phase('upload'):
+                        upload = await client.post_batch(item, files=files)
+                status_code = upload.status_code
+                batches_pushed.labels(status_code).inc()
+                logger.info('Pushed a batch: %s, status: %d, documents: %d, features: %d', batch_id, status_code, stats.documents, stats.features)
+                stats.observe()
+        finally:
+            await response.aclose()
+        if status_code == 429 or status_code >= 500:
+            raise Exception(f'Discovery responded with status {status_code}')
+        q.done(item)
+    except Exception as e:
+        logger.error('An error occurred: %s', e, exc_info=True)
+        batch_errors.labels(type(e).__name__).inc()
+        # Retry with backoff
+        state = q.fail(item, e)
+        if state == 'dead':
+            batches_dead.inc()
+            logger.error('Gave up a batch: %s', batch_id)
+        else:
+            batch_retries.inc()
+
+async def dispatch_batches(q, client, enrich_stream, workers, streaming, logger):
+    """Take batches from the TaskQueue q as long as fewer than workers are in flight, and enrich them concurrently with enrich_batch()."""
+    loop = asyncio.get_running_loop()
+    # The task queue blocks, so it is read in a thread of its own that the enrichment cannot starve
+    reader = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='queue')
+    slots = asyncio.Semaphore(workers)
+    tasks = set()
+    try:
+        while True:
+            await slots.acquire()
+            item = None
+            while item is None:
+                # Wake up every second to notice the cancellation at shutdown
+                item = await loop.run_in_executor(reader, q.get, 1.0)
+            task = asyncio.create_task(enrich_batch(q, client, item, enrich_stream, streaming, logger))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        # Interrupted batches are running in the queue file, and are requeued at the next start
+        for task in tasks:
+            task.cancel()
+        reader.shutdown(wait=False)
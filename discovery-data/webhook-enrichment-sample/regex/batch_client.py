@@ -0,0 +1,59 @@
+import requests
+import urllib3
+import zlib
+
+class DiscoveryBatchClient:
+    """Client of the Discovery batch API over pooled keep-alive connections.
+
+    Downloads are retried on connection errors and 429/5xx responses. Uploads are not, because a streamed
+    body cannot be replayed, so failed uploads are retried by the task queue instead.
+    """
+
+    def __init__(self, api_url, api_key, pool_size, timeout, max_retries):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = ('apikey', api_key)
+        retry = urllib3.util.Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+            raise_on_status=False
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def batch_api(self, item):
+        data = item['data']
+        return f'{self.api_url}/v2/projects/{data["project_id"]}/collections/{data["collection_id"]}/batches/{data["batch_id"]}'
+
+    def get_batch(self, item):
+        params = {'version': item['version']}
+        headers = {'Accept-Encoding': 'gzip'}
+        return self.session.get(self.batch_api(item), params=params, headers=headers, stream=True, timeout=self.timeout)
+
+    def post_batch(self, item, **kwargs):
+        params = {'version': item['version']}
+        return self.session.post(self.batch_api(item), params=params, timeout=self.timeout, **kwargs)
+
+def gzip_ndjson(lines):
+    # wbits=31 produces the gzip container format
+    compressor = zlib.compressobj(wbits=31)
+    separator = b''
+    for line in lines:
+        chunk = compressor.compress(separator + line)
+        separator = b'\n'
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+def multipart_stream(boundary, chunks):
+    yield (
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="file"; filename="data.ndjson.gz"\r\n'
+        'Content-Type: application/x-ndjson\r\n\r\n'
+    ).encode('utf-8')
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
@@ -0,0 +1,105 @@
+import gzip
+import uuid
+
+from batch_client import gzip_ndjson, multipart_stream
+from batch_stats import BatchStats, batch_errors, batch_retries, batches_dead, batches_pulled, batches_pushed
+from task_queue import QueueFullError
+
+def enrichment_worker(q, client, enrich_stream, streaming, logger):
+    """Take batches from the TaskQueue q forever, and pull, enrich and push each of them with the DiscoveryBatchClient client.
+
+    enrich_stream(lines, stats) yields the enriched lines of the downloaded lines of a batch, and counts them in stats.
+    With streaming, a batch is uploaded while it is still being downloaded and enriched.
+    """
+    while True:
+        item = q.get()
+        batch_id = item['data']['batch_id']
+        stats = BatchStats()
+        try:
+            # Get documents from WD
+            with stats.phase('download'):
+                response = client.get_batch(item)
+            with response:
+                status_code = response.status_code
+                batches_pulled.labels(status_code).inc()
+                logger.info('Pulled a batch: %s, status: %d', batch_id, status_code)
+                if status_code == 200:
+                    # Annotate documents
+                    enriched_lines = stats.timed('enrich', enrich_stream(stats.timed('download', response.iter_lines()), stats))
+                    if streaming:
+                        # Upload annotated documents while the batch is still being downloaded and enriched
+                        boundary = uuid.uuid4().hex
+                        body = multipart_stream(boundary, stats.timed('compress', gzip_ndjson(enriched_lines)))
+                        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+                        with stats.phase('upload'):
+                            response = client.post_batch(item, data=body, headers=headers)
+                    else:
+                        with stats.phase('compress'):
+                            data = gzip.compress(b'\n'.join(enriched_lines))
+                        files = {
+                            'file': (
+                                'data.ndjson.gz',
+                                data,
+                                'application/x-ndjson'
+                            )
+                        }
+                        # Upload annotated documents
+                        with stats.phase('upload'):
+                            response = client.post_batch(item, files=files)
+                    status_code = response.status_code
+                    batches_pushed.labels(status_code).inc()
+                    logger.info('Pushed a batch: %s, status: %d, documents: %d, features: %d', batch_id, status_code, stats.documents, stats.features)
+                    stats.observe()
+            if status_code == 429 or status_code >= 500:
+                raise Exception(f'Discovery responded with status {status_code}')
+            q.done(item)
+        except Exception as e:
+            logger.error('An error occurred: %s', e, exc_info=True)
+            batch_errors.labels(type(e).__name__).inc()
+            # Retry with backoff
+            state = q.fail(item, e)
+            if state == 'dead':
+                batches_dead.inc()
+                logger.error('Gave up a batch: %s', batch_id)
+            else:
+                batch_retries.inc()
+
+def handle_event(q, data, high_water_mark, retry_after, logger):
+    """Process a webhook event and return the body, status code and headers of the response.
+
+    Batches are queued in the TaskQueue q, and rejected while high_water_mark batches are pending.
+    """
+    event = data['event']
+    logger.info('Received event: %s, batch: %s', event, data.get('data', {}).get('batch_id'))
+    logger.debug('Event: %s', data)
+    body = {}
+    headers = {}
+    if event == 'ping':
+        # Receive this event when a webhook enrichment is created
+        code = 200
+        status = 'ok'
+        body['queue'] = q.stats()
+    elif event == 'enrichment.batch.created' and q.qsize() >= high_water_mark:
+        # Ask Discovery to retry later rather than queuing beyond the high-water mark
+        logger.warning('Rejected a batch: %d batches are pending', q.qsize())
+        code = 429
+        status = 'too many requests'
+        headers['Retry-After'] = str(retry_after)
+    elif event == 'enrichment.batch.created':
+        # Receive this event when a batch of the documents gets ready
+        code = 202
+        status = 'accepted'
+        # Put an enrichment request into the queue
+        try:
+            if not q.put(data):
+                logger.info('Ignored a duplicate batch: %s', data['data']['batch_id'])
+        except QueueFullError as e:
+            logger.warning('Rejected a batch: %s', e)
+            code = 503
+            status = 'queue full'
+            headers['Retry-After'] = str(retry_after)
+    else:
+        # Unknown event type
+        code = 400
+        status = 'bad request'
+    return {'status': status, **body}, code, headers
@@ -0,0 +1,74 @@
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import main
+
+# Keep per-document logging out of the measurement, also in the spawned pool processes
+main.app.logger.setLevel(logging.WARNING)
+
+def load_documents(path, count, repeat):
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    lines = []
+    for i in range(count):
+        text = ' '.join([rows[i % len(rows)]['text']] * repeat)
+        doc = {
+            'document_id': str(i),
+            'artifact': text,
+            'features': [
+                {
+                    'type': 'field',
+                    'location': {'begin': 0, 'end': len(text)},
+                    'properties': {'field_name': 'text'},
+                }
+            ],
+        }
+        lines.append(json.dumps(doc).encode('utf-8'))
+    return lines
+
+def run(lines, workers):
+    if workers == 0:
+        main.enrichment_pool = None
+    else:
+        main.ENRICHMENT_WORKERS = workers
+        main.enrichment_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        # Warm up the pool processes so that their start-up is not measured
+        list(main.enrich_stream(lines[:workers * main.ENRICHMENT_CHUNK_SIZE]))
+    start = time.perf_counter()
+    enriched_lines = list(main.enrich_stream(lines))
+    elapsed = time.perf_counter() - start
+    if main.enrichment_pool is not None:
+        main.enrichment_pool.shutdown()
+    assert [json.loads(line)['document_id'] for line in enriched_lines] == [str(i) for i in range(len(lines))]
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure enrichment throughput of the process pool against the number of cores.')
+    parser.add_argument('--data', default=os.path.join(os.path.dirname(__file__), 'data', 'nhtsa.csv'))
+    parser.add_argument('--documents', type=int, default=20000, help='number of documents per batch')
+    parser.add_argument('--repeat', type=int, default=10, help='number of times the text of each row is repeated in a document')
+    parser.add_argument('--chunk-size', type=int, default=main.ENRICHMENT_CHUNK_SIZE)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    main.ENRICHMENT_CHUNK_SIZE = args.chunk_size
+    lines = load_documents(args.data, args.documents, args.repeat)
+    workers_list = [0] + [n for n in (1, 2, 4, 8, 16, 32, 64) if n < args.max_workers] + [args.max_workers]
+
+    print(f'{args.documents} documents, chunk size {args.chunk_size}')
+    print(f'{"workers":>8} {"seconds":>9} {"docs/sec":>10} {"speedup":>8}')
+    baseline = None
+    for workers in workers_list:
+        elapsed = run(lines, workers)
+        baseline = baseline or elapsed
+        label = 'inline' if workers == 0 else str(workers)
+        print(f'{label:>8} {elapsed:9.3f} {len(lines) / elapsed:10.1f} {baseline / elapsed:7.2f}x')
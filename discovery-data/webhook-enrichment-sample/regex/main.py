@@ -1,34 +1,181 @@
+import collections
+import concurrent.futures
 import flask
-import gzip
+import itertools
 import json
 import jwt
 import logging
+import multiprocessing
 import os
-import queue
+import prometheus_client
 import re
-import requests
 import threading
 import time
 
+import batch_worker
+from batch_client import DiscoveryBatchClient
+from batch_stats import BatchStats, register_queue_gauges, webhook_auth
+from features import FeatureBuffer, load_codec
+from task_queue import TaskQueue
+from webhook_verifier import WebhookVerifier
+
 WD_API_URL = os.getenv('WD_API_URL')
 WD_API_KEY = os.getenv('WD_API_KEY')
 WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Connect and read timeouts of Discovery batch API requests in seconds
+WD_CONNECT_TIMEOUT = float(os.getenv('WD_CONNECT_TIMEOUT', '10'))
+WD_READ_TIMEOUT = float(os.getenv('WD_READ_TIMEOUT', '300'))
+# Maximum number of retries of a Discovery batch download
+WD_MAX_RETRIES = int(os.getenv('WD_MAX_RETRIES', '3'))
+# Number of enrichment workers
+ENRICHMENT_WORKERS = int(os.getenv('ENRICHMENT_WORKERS', str(os.cpu_count() or 1)))
+# 'thread' runs enrichment in the worker threads, 'process' offloads it to a process pool
+ENRICHMENT_POOL = os.getenv('ENRICHMENT_POOL', 'thread')
+# Number of documents sent to a pool process at a time
+ENRICHMENT_CHUNK_SIZE = int(os.getenv('ENRICHMENT_CHUNK_SIZE', '32'))
+# Stream documents from the download through enrichment to the upload instead of buffering the whole batch
+STREAMING = os.getenv('STREAMING', 'false').lower() == 'true'
+# Level of the application log
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Log the full payloads of one in LOG_SAMPLE_RATE documents at the DEBUG level, or none with 0
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '100'))
+# JSON codec of batch documents: 'auto' uses orjson or msgspec when installed, or 'orjson', 'msgspec' or 'json'
+JSON_CODEC = os.getenv('JSON_CODEC', 'auto')
+# SQLite file of the persistent enrichment task queue
+QUEUE_PATH = os.getenv('QUEUE_PATH', 'queue.sqlite3')
+# Maximum number of pending batches
+QUEUE_CAPACITY = int(os.getenv('QUEUE_CAPACITY', '10000'))
+# Maximum number of attempts of a batch before it is dead-lettered
+MAX_ATTEMPTS = int(os.getenv('MAX_ATTEMPTS', '8'))
+# Base and cap of the exponential retry backoff in seconds
+RETRY_BACKOFF_BASE = float(os.getenv('RETRY_BACKOFF_BASE', '2'))
+RETRY_BACKOFF_MAX = float(os.getenv('RETRY_BACKOFF_MAX', '600'))
+# Seconds to remember completed batches, so that redelivered events are ignored
+COMPLETED_RETENTION = float(os.getenv('COMPLETED_RETENTION', str(24 * 60 * 60)))
+# Queue depth from which new batches are rejected with 429 until the workers catch up
+QUEUE_HIGH_WATER_MARK = int(os.getenv('QUEUE_HIGH_WATER_MARK', '1000'))
+# Seconds Discovery is asked to wait before redelivering a rejected batch
+RETRY_AFTER = int(os.getenv('RETRY_AFTER', '60'))
+# Seconds a verified webhook token is trusted without checking its signature again
+WEBHOOK_TOKEN_CACHE_TTL = float(os.getenv('WEBHOOK_TOKEN_CACHE_TTL', '60'))
+
+# Enrichment task queue. It is opened by open_task_queue() when the workers start, so that importers of this module,
+# such as spawned pool processes and the benchmark, do not create the queue file.
+q = None
+
+def open_task_queue():
+    global q
+    q = TaskQueue(QUEUE_PATH, QUEUE_CAPACITY, MAX_ATTEMPTS, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX, COMPLETED_RETENTION)
+    register_queue_gauges(q)
+
+# Annotation rules by regular expressions
+RULES_FILE = os.getenv('RULES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json'))
+
+class Annotator:
+    """Annotates text with all entity, sentence class and document class rules in a single scan.
+
+    The rule patterns are combined into one alternation, so they must not contain named groups.
+    So that the matches of a rule do not hide those of the others, the scan resumes right after the start
+    of each match instead of its end, and the rules after the one that matched in the order entities,
+    element classes, document classes and sentence break are tried at the same position as well.
+    Each rule finds the same matches as re.finditer() with its pattern alone.
+    """
+
+    def __init__(self, rules):
+        self.entities = rules.get('entities', [])
+        self.element_classes = rules.get('element_classes', [])
+        self.document_classes = rules.get('document_classes', [])
+        patterns = {f'e{i}': rule['pattern'] for i, rule in enumerate(self.entities)}
+        patterns.update((f'c{i}', rule['pattern']) for i, rule in enumerate(self.element_classes))
+        patterns.update((f'd{i}', rule['pattern']) for i, rule in enumerate(self.document_classes))
+        patterns['b'] = rules['sentence_break']
+        self.names = list(patterns)
+        groups = [f'(?P<{name}>{pattern})' for name, pattern in patterns.items()]
+        self.pattern = re.compile('|'.join(groups))
+        # Rules after each rule, tried at the positions where it matches. (?!) never matches.
+        self.later_patterns = {name: re.compile('|'.join(groups[i + 1:]) or '(?!)') for i, name in enumerate(self.names)}
+        # Properties are built once per rule and shared by all of its annotations
+        self.entity_properties = [
+            {'type': 'entities', 'confidence': rule.get('confidence', 1.0), 'entity_type': rule['entity_type']}
+            for rule in self.entities
+        ]
+        self.element_class_properties = [self.class_properties('element_classes', rule) for rule in self.element_classes]
+        self.document_class_properties = [self.class_properties('document_classes', rule) for rule in self.document_classes]
 
-# Enrichment task queue
-q = queue.Queue()
+    @staticmethod
+    def class_properties(class_type, rule):
+        """Return the properties of the (default class, class) of a rule."""
+        return tuple(
+            {'type': class_type, 'class_name': rule[key], 'confidence': rule.get('confidence', 1.0)}
+            for key in ('default_class_name', 'class_name')
+        )
 
-# Extractors by regular expressions
-year_entity_extractor = re.compile('\d{4}')
-sentence_break_detector = re.compile('\.\s*|!\s*|\?\s*')
-transmission_extractor = re.compile('TRANSMISSION')
-slip_classifier = re.compile('SLIP')
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def annotate(self, text):
+        """Yield (begin, end, properties, entity_text) for each annotation.
+
+        begin and end are None for document classes and entity_text is None for classes.
+        The properties are shared, so they must not be modified.
+        """
+        matched_element_classes = set()
+        matched_document_classes = set()
+        sentence_start = 0
+        # End of the last match of each rule, before which the rule does not match again
+        ends = dict.fromkeys(self.names, 0)
+        matched = self.pattern.search(text)
+        while matched is not None:
+            position = matched.start()
+            # Each rule that matches at the position, the first one found by the scan and then those after it
+            while matched is not None:
+                name = matched.lastgroup
+                end = matched.end(name)
+                matched = self.later_patterns[name].match(text, position)
+                if position < ends[name]:
+                    continue
+                ends[name] = end
+                if name == 'b':
+                    # Sentence classification
+                    sentence_end = position + 1
+                    for i, properties in enumerate(self.element_class_properties):
+                        yield sentence_start, sentence_end, properties[i in matched_element_classes], None
+                    matched_element_classes.clear()
+                    sentence_start = end
+                elif name[0] == 'e':
+                    # Entity extraction
+                    yield position, end, self.entity_properties[int(name[1:])], text[position:end]
+                elif name[0] == 'c':
+                    matched_element_classes.add(int(name[1:]))
+                else:
+                    matched_document_classes.add(int(name[1:]))
+            matched = self.pattern.search(text, position + 1)
+        # Document classification
+        for i, properties in enumerate(self.document_class_properties):
+            yield None, None, properties[i in matched_document_classes], None
+
+annotator = Annotator.from_file(RULES_FILE)
 
 app = flask.Flask(__name__)
-app.logger.setLevel(logging.INFO)
+app.logger.setLevel(LOG_LEVEL)
 app.logger.handlers[0].setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s (%(filename)s:%(lineno)d)'))
 
+# Number of documents considered for payload logging
+logged_documents = itertools.count()
+
+def log_payload():
+    """Return whether to log the full payloads of a document.
+
+    Only one in LOG_SAMPLE_RATE documents is logged, and the counter does not even advance while DEBUG is disabled.
+    """
+    return LOG_SAMPLE_RATE > 0 and app.logger.isEnabledFor(logging.DEBUG) and next(logged_documents) % LOG_SAMPLE_RATE == 0
+
+json_loads, json_dumps = load_codec(JSON_CODEC)
+
 def enrich(doc):
-    features_to_send = []
+    features_to_send = FeatureBuffer(doc['document_id'])
     for feature in doc['features']:
         # Target 'text' field
         if feature['properties']['field_name'] != 'text':
@@ -38,150 +185,119 @@ def enrich(doc):
         end = location['end']
         text = doc['artifact'][begin:end]
         try:
-            # Entity extraction example
-            for matched in year_entity_extractor.finditer(text):
-                features_to_send.append(
-                    {
-                        'type': 'annotation',
-                        'location': {
-                            'begin': matched.start() + begin,
-                            'end': matched.end() + begin,
-                        },
-                        'properties': {
-                            'type': 'entities',
-                            'confidence': 1.0,
-                            'entity_type': 'Year',
-                            'entity_text': matched.group(0),
-                        },
-                    }
-                )
-            # Sentence classification example
-            sentence_start = 0
-            for matched in sentence_break_detector.finditer(text):
-                sentence_end = matched.start() + 1
-                sentence_text = text[sentence_start:sentence_end]
-                if transmission_extractor.search(sentence_text):
-                    class_name = 'Transmission'
+            for annotation_begin, annotation_end, properties, entity_text in annotator.annotate(text):
+                if annotation_begin is None:
+                    features_to_send.annotation(None, None, properties)
                 else:
-                    class_name = 'No Transmission'
-                features_to_send.append(
-                    {
-                        'type': 'annotation',
-                        'location': {
-                            'begin': sentence_start + begin,
-                            'end': sentence_end + begin,
-                        },
-                        'properties': {
-                            'type': 'element_classes',
-                            'class_name': class_name,
-                            'confidence': 1.0,
-                        },
-                    },
-                )
-                sentence_start = matched.end()
-            # Document classification example
-            if slip_classifier.search(text):
-                class_name = 'Slip'
-            else:
-                class_name = 'No Slip'
-            features_to_send.append(
-                {
-                    'type': 'annotation',
-                    'properties': {
-                        'type': 'document_classes',
-                        'class_name': class_name,
-                        'confidence': 1.0,
-                    },
-                },
-            )
+                    features_to_send.annotation(annotation_begin + begin, annotation_end + begin, properties, entity_text)
         except Exception as e:
             # Notice example
-            features_to_send.append(
-                {
-                    'type': 'notice',
-                    'properties': {
-                        'description': str(e),
-                        'created': round(time.time() * 1000),
-                    },
-                }
-            )
-    app.logger.info('features_to_send: %s', features_to_send)
-    return {'document_id': doc['document_id'], 'features': features_to_send}
-
-def enrichment_worker():
-    while True:
-        item = q.get()
-        version = item['version']
-        data = item['data']
-        project_id = data['project_id']
-        collection_id = data['collection_id']
-        batch_id = data['batch_id']
-        batch_api = f'{WD_API_URL}/v2/projects/{project_id}/collections/{collection_id}/batches/{batch_id}'
-        params = {'version': version}
-        auth = ('apikey', WD_API_KEY)
-        headers = {'Accept-Encoding': 'gzip'}
-        try:
-            # Get documents from WD
-            response = requests.get(batch_api, params=params, auth=auth, headers=headers, stream=True)
-            status_code = response.status_code
-            app.logger.info('Pulled a batch: %s, status: %d', batch_id, status_code)
-            if status_code == 200:
-                # Annotate documents
-                enriched_docs = [enrich(json.loads(line)) for line in response.iter_lines()]
-                files = {
-                    'file': (
-                        'data.ndjson.gz',
-                        gzip.compress(
-                            '\n'.join(
-                                [json.dumps(enriched_doc) for enriched_doc in enriched_docs]
-                            ).encode('utf-8')
-                        ),
-                        'application/x-ndjson'
-                    )
-                }
-                # Upload annotated documents
-                response = requests.post(batch_api, params=params, files=files, auth=auth)
-                status_code = response.status_code
-                app.logger.info('Pushed a batch: %s, status: %d', batch_id, status_code)
-        except Exception as e:
-            app.logger.error('An error occurred: %s', e, exc_info=True)
-            # Retry
-            q.put(item)
+            features_to_send.notice(str(e), round(time.time() * 1000))
+    app.logger.debug('Enriched a document: %s, features: %d', doc['document_id'], len(features_to_send))
+    if log_payload():
+        app.logger.debug('features_to_send: %s', features_to_send.encode(json_dumps).decode('utf-8'))
+    return features_to_send
+
+def enrich_lines(lines):
+    # Pool processes return serialized documents, which are cheaper to send back than feature buffers
+    enriched_lines = []
+    features = 0
+    for line in lines:
+        features_to_send = enrich(json_loads(line))
+        enriched_lines.append(features_to_send.encode(json_dumps))
+        features += len(features_to_send)
+    return enriched_lines, features
+
+# Process pool for CPU-bound enrichment, created in start_enrichment_workers()
+enrichment_pool = None
+
+def enrich_stream(lines, stats=None):
+    """Yield the enriched lines of a batch. stats, a BatchStats, counts documents and features.
+
+    Parsing is timed as a phase of its own, except in the pool processes.
+    """
+    stats = stats or BatchStats()
+    if enrichment_pool is None:
+        for line in lines:
+            with stats.phase('parse'):
+                doc = json_loads(line)
+            features_to_send = enrich(doc)
+            stats.documents += 1
+            stats.features += len(features_to_send)
+            yield features_to_send.encode(json_dumps)
+        return
+    # Fan documents out to the process pool in chunks, keeping the results in order
+    # and a bounded number of chunks in flight
+    lines = iter(lines)
+    pending = collections.deque()
+    while chunk := list(itertools.islice(lines, ENRICHMENT_CHUNK_SIZE)):
+        pending.append(enrichment_pool.submit(enrich_lines, chunk))
+        if len(pending) > ENRICHMENT_WORKERS:
+            yield from collect(pending.popleft(), stats)
+    while pending:
+        yield from collect(pending.popleft(), stats)
 
-# Turn on the enrichment worker thread
-threading.Thread(target=enrichment_worker, daemon=True).start()
+def collect(future, stats):
+    enriched_lines, features = future.result()
+    stats.documents += len(enriched_lines)
+    stats.features += features
+    return enriched_lines
+
+# Uploads of a worker run while its download is still open
+discovery_client = DiscoveryBatchClient(WD_API_URL, WD_API_KEY, ENRICHMENT_WORKERS * 2, (WD_CONNECT_TIMEOUT, WD_READ_TIMEOUT), WD_MAX_RETRIES)
+
+def start_enrichment_pool():
+    global enrichment_pool
+    if ENRICHMENT_POOL == 'process':
+        enrichment_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=ENRICHMENT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+def start_enrichment_workers():
+    start_enrichment_pool()
+    open_task_queue()
+    q.recover()
+    for _ in range(ENRICHMENT_WORKERS):
+        threading.Thread(target=batch_worker.enrichment_worker, args=(q, discovery_client, enrich_stream, STREAMING, app.logger), daemon=True).start()
+    app.logger.info('Started %d enrichment workers (%s pool)', ENRICHMENT_WORKERS, ENRICHMENT_POOL)
+
+# Metrics endpoint in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return prometheus_client.generate_latest(), 200, {'Content-Type': prometheus_client.CONTENT_TYPE_LATEST}
+
+# Health endpoint. Reports 503 while the queue is over the high-water mark, so that load balancers shed load.
+@app.route('/health', methods=['GET'])
+def health():
+    stats = q.stats()
+    if stats['depth'] >= QUEUE_HIGH_WATER_MARK:
+        return {'status': 'overloaded', 'queue': stats}, 503, {'Retry-After': str(RETRY_AFTER)}
+    return {'status': 'ok', 'queue': stats}, 200, {}
+
+webhook_verifier = WebhookVerifier(WEBHOOK_SECRET, WEBHOOK_TOKEN_CACHE_TTL)
 
 # Webhook endpoint
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    return handle_webhook(flask.request.headers.get('Authorization'), flask.request.data)
+
+def handle_webhook(authorization, data):
+    """Verify the Authorization header of a webhook request, process its event and return the body, status code and headers of the response."""
     # Verify JWT token
-    header = flask.request.headers.get('Authorization')
-    _, token = header.split()
     try:
-        jwt.decode(token, WEBHOOK_SECRET, algorithms=['HS256'])
+        cached = webhook_verifier.verify(authorization)
     except jwt.PyJWTError as e:
+        webhook_auth.labels('rejected').inc()
         app.logger.error('Invalid token: %s', e)
-        return {'status': 'unauthorized'}, 401
+        return {'status': 'unauthorized'}, 401, {}
+    webhook_auth.labels('cached' if cached else 'verified').inc()
     # Process webhook event
-    data = flask.json.loads(flask.request.data)
-    app.logger.info('Received event: %s', data)
-    event = data['event']
-    if event == 'ping':
-        # Receive this event when a webhook enrichment is created
-        code = 200
-        status = 'ok'
-    elif event == 'enrichment.batch.created':
-        # Receive this event when a batch of the documents gets ready
-        code = 202
-        status = 'accepted'
-        # Put an enrichment request into the queue
-        q.put(data)
-    else:
-        # Unknown event type
-        code = 400
-        status = 'bad request'
-    return {'status': status}, code
+    return batch_worker.handle_event(q, json_loads(data), QUEUE_HIGH_WATER_MARK, RETRY_AFTER, app.logger)
 
 PORT = os.getenv('PORT', '8080')
 if __name__ == '__main__':
+    # Turn on the enrichment worker threads. They are not started on import, so that spawned pool
+    # processes and the async server in asgi.py, which import this module, do not run them.
+    start_enrichment_workers()
     app.run(host='0.0.0.0', port=int(PORT))